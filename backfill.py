@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from checkpoint import incoming_ride_ids, merge_pending_rides, write_checkpoints, write_pending_rides
+from config import get_config
+from extract import advance_checkpoint, db_session, extract_db_table, get_ftps, parse_payments, parse_waybills
+from extract import read_state, records_to_frame
+from logger import logger
+from transform_and_load import reconcile_dimensions, update_dim_cars, update_dim_clients, update_dim_drivers
+from transform_and_load import update_fact_payments, update_fact_rides, update_fact_waybills
+
+CONFIG = get_config()
+
+# Число процессов и размер части (число поездок) при первичной загрузке истории
+BACKFILL_WORKERS = int(CONFIG.get('BACKFILL_WORKERS', os.cpu_count() or 1))
+BACKFILL_PARTITION_RIDES = int(CONFIG.get('BACKFILL_PARTITION_RIDES', 100000))
+
+
+def plan_backfill(checkpoints: dict) -> dict:
+    """Границы загрузки: от сохраненных контрольных точек до текущих максимальных id в источнике"""
+    with db_session() as (cursor, connection):
+        # Оба максимума берутся одним запросом (один снимок данных); movement читается первым,
+        # поэтому все его события до границы относятся к поездкам до границы rides
+        cursor.execute("SELECT (SELECT max(movement_id) FROM main.movement), (SELECT max(ride_id) FROM main.rides)")
+        movement_to, ride_to = cursor.fetchone()
+
+    # Если новых строк нет, верхняя граница совпадает с текущей контрольной точкой
+    ride_from = int(checkpoints['main.rides']['id']) + 1
+    movement_from = int(checkpoints['main.movement']['id']) + 1
+    return {'ride_from': ride_from, 'ride_to': max(int(ride_to or 0), ride_from - 1),
+            'movement_from': movement_from, 'movement_to': max(int(movement_to or 0), movement_from - 1),
+            'partition': BACKFILL_PARTITION_RIDES}
+
+
+@logger
+def load_backfill_dimensions(checkpoints: dict, plan: dict) -> None:
+    """Загрузка измерений и путевых листов до фактов о поездках (в обычном инкрементальном режиме)"""
+    drivers = extract_db_table('main.drivers', checkpoints['main.drivers'])
+    car_pool = extract_db_table('main.car_pool', checkpoints['main.car_pool'])
+
+    # Клиенты агрегируются в источнике: первая поездка и карта из последней поездки
+    with db_session() as (cursor, connection):
+        cursor.execute('''SELECT client_phone, min(dt) AS dt, (array_agg(card_num ORDER BY dt DESC))[1] AS card_num
+                          FROM main.rides
+                          WHERE ride_id BETWEEN %s AND %s
+                          GROUP BY client_phone''', (plan['ride_from'], plan['ride_to']))
+        clients = records_to_frame(cursor.fetchall(), [desc[0] for desc in cursor.description])
+
+    ftp_data, manifest = get_ftps({key: checkpoints[f'ftp:{key}'] for key in ['waybills', 'payments']})
+    waybills = parse_waybills(ftp_data['waybills']) if ftp_data['waybills'] else pd.DataFrame()
+    payments = parse_payments(ftp_data['payments']) if ftp_data['payments'] else pd.DataFrame()
+
+    with db_session(dwh=True) as (cursor, connection):
+        update_dim_drivers(cursor, drivers)
+        write_checkpoints(cursor, {'main.drivers': advance_checkpoint('main.drivers', checkpoints['main.drivers'],
+                                                                      drivers)})
+        connection.commit()
+
+        update_dim_clients(cursor, clients)
+        connection.commit()
+
+        update_dim_cars(cursor, car_pool)
+        write_checkpoints(cursor, {'main.car_pool': advance_checkpoint('main.car_pool', checkpoints['main.car_pool'],
+                                                                       car_pool)})
+        connection.commit()
+
+        # Путевые листы загружаются до поездок: по ним определяются водители
+        if not waybills.empty:
+            update_fact_waybills(cursor, waybills)
+        write_checkpoints(cursor, {'ftp:waybills': manifest['waybills']})
+        connection.commit()
+
+        update_fact_payments(cursor, payments)
+        write_checkpoints(cursor, {'ftp:payments': manifest['payments']})
+        connection.commit()
+
+
+def load_partition(plan: dict, ride_from: int, ride_to: int) -> tuple:
+    """Загрузка поездок с ride_id из диапазона (выполняется в отдельном процессе, своей транзакцией)"""
+    with db_session() as (cursor, connection):
+        cursor.execute("select * from main.rides where ride_id between %s and %s", (ride_from, ride_to))
+        rides = records_to_frame(cursor.fetchall(), [desc[0] for desc in cursor.description])
+        cursor.execute("select * from main.movement where ride between %s and %s and movement_id between %s and %s",
+                       (ride_from, ride_to, plan['movement_from'], plan['movement_to']))
+        movement = records_to_frame(cursor.fetchall(), [desc[0] for desc in cursor.description])
+
+    with db_session(dwh=True) as (cursor, connection):
+        # События поездок части, полученные раньше строк rides (movement_id до начала загрузки), уже в буфере
+        changed = incoming_ride_ids(rides, movement)
+        rides, movement = merge_pending_rides(cursor, rides, movement, partition=True)
+        # Водители определяются по fact_waybills, загруженным до начала параллельной загрузки
+        loaded, unfinished = update_fact_rides(cursor, rides, movement, pd.DataFrame())
+        write_pending_rides(cursor, rides, movement, list(loaded['ride_id']), unfinished, changed)
+        # Отметка о загруженной части сохраняется вместе с ее данными - по ней загрузка продолжается после сбоя
+        write_checkpoints(cursor, {f'backfill:{ride_from}': {'ride_to': ride_to}})
+        connection.commit()
+
+    return ride_from, ride_to, len(loaded), len(unfinished)
+
+
+def load_pending_movement(cursor, plan: dict) -> None:
+    """Загрузка новых событий поездок, начатых до загрузки истории (они уже в буфере незавершенных поездок)"""
+    # В части попадают только события поездок из диапазона rides, события более ранних поездок загружаются здесь
+    with db_session() as (source_cursor, source_connection):
+        source_cursor.execute("select * from main.movement where ride < %s and movement_id between %s and %s",
+                              (plan['ride_from'], plan['movement_from'], plan['movement_to']))
+        movement = records_to_frame(source_cursor.fetchall(), [desc[0] for desc in source_cursor.description])
+
+    changed = incoming_ride_ids(pd.DataFrame(), movement)
+    rides, movement = merge_pending_rides(cursor, pd.DataFrame(), movement)
+    loaded, unfinished = update_fact_rides(cursor, rides, movement, pd.DataFrame())
+    write_pending_rides(cursor, rides, movement, list(loaded['ride_id']), unfinished, changed)
+    print(f'События ранее начатых поездок: {len(movement)}, загружено поездок {len(loaded)}')
+
+
+@logger
+def reconcile_backfill(plan: dict, partitions: list) -> None:
+    """Загрузка событий ранее начатых поездок, пересчет start_dt/end_dt измерений
+    и перенос контрольных точек rides/movement одной транзакцией"""
+    with db_session(dwh=True) as (cursor, connection):
+        load_pending_movement(cursor, plan)
+        reconcile_dimensions(cursor)
+        write_checkpoints(cursor, {'main.rides': {'id': plan['ride_to']},
+                                   'main.movement': {'id': plan['movement_to']}})
+        cursor.execute("DELETE FROM dwh_voronezh.etl_checkpoints WHERE source = 'backfill' OR source = ANY(%s)",
+                       ([f'backfill:{ride_from}' for ride_from, _ in partitions],))
+        connection.commit()
+
+
+def run_backfill(workers: int = BACKFILL_WORKERS) -> None:
+    """Загрузка истории частями по диапазонам ride_id в пуле процессов с последующим согласованием измерений"""
+    checkpoints, _ = read_state()
+
+    # План сохраняется в DWH: повторный запуск после сбоя продолжает его и пропускает загруженные части
+    plan = checkpoints.get('backfill')
+    if plan is None:
+        plan = plan_backfill(checkpoints)
+        with db_session(dwh=True) as (cursor, connection):
+            write_checkpoints(cursor, {'backfill': plan})
+            connection.commit()
+    print(f"Загрузка истории: поездки {plan['ride_from']} - {plan['ride_to']}, "
+          f"события {plan['movement_from']} - {plan['movement_to']}")
+
+    load_backfill_dimensions(checkpoints, plan)
+
+    partitions = [(ride_from, min(ride_from + plan['partition'] - 1, plan['ride_to']))
+                  for ride_from in range(plan['ride_from'], plan['ride_to'] + 1, plan['partition'])]
+    pending = [partition for partition in partitions if f'backfill:{partition[0]}' not in checkpoints]
+    print(f'Частей: {len(partitions)}, осталось загрузить: {len(pending)}')
+
+    # Процессы запускаются через spawn: соединения из пулов родительского процесса не наследуются
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(load_partition, plan, ride_from, ride_to): (ride_from, ride_to)
+                   for ride_from, ride_to in pending}
+        for future in as_completed(futures):
+            ride_from, ride_to = futures[future]
+            try:
+                _, _, loaded, unfinished = future.result()
+                print(f'Часть {ride_from} - {ride_to}: загружено поездок {loaded}, незавершенных {unfinished}')
+            except Exception as error:
+                failed.append((ride_from, ride_to))
+                print(f'Ошибка загрузки части {ride_from} - {ride_to}:', error)
+
+    # Контрольные точки rides/movement переносятся, только когда загружены все части
+    if failed:
+        raise RuntimeError(f'Не загружено частей: {len(failed)}; повторный запуск продолжит загрузку')
+    reconcile_backfill(plan, partitions)
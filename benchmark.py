@@ -0,0 +1,484 @@
+import argparse
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import psycopg2
+
+# Параметры локального PostgreSQL, в котором создаются временные базы источника и DWH
+BENCH_POSTGRES = {
+    'user': os.environ.get('BENCH_POSTGRES_USER', 'postgres'),
+    'password': os.environ.get('BENCH_POSTGRES_PASSWORD', ''),
+    'host': os.environ.get('BENCH_POSTGRES_HOST', 'localhost'),
+    'port': os.environ.get('BENCH_POSTGRES_PORT', '5432'),
+}
+SOURCE_DB = 'etl_bench_source'
+DWH_DB = 'etl_bench_dwh'
+
+FTP_USER = 'bench'
+FTP_PASSWORD = 'bench'
+
+# Этапы ETL-процесса, по которым строится сводка
+TOP_STAGES = ['extract_data', 'transform_and_load_data', 'make_reports']
+
+SOURCE_DDL = '''
+CREATE SCHEMA main;
+CREATE TABLE main.car_pool(
+    plate_num text PRIMARY KEY,
+    model text,
+    revision_dt date,
+    register_dt timestamp,
+    finished_flg char(1),
+    update_dt timestamp);
+CREATE TABLE main.drivers(
+    driver_license text PRIMARY KEY,
+    first_name text,
+    last_name text,
+    middle_name text,
+    driver_valid_to date,
+    card_num text,
+    update_dt timestamp,
+    birth_dt date);
+CREATE TABLE main.rides(
+    ride_id bigint PRIMARY KEY,
+    dt timestamp,
+    client_phone text,
+    card_num text,
+    point_from text,
+    point_to text,
+    distance numeric(5, 2),
+    price numeric(7, 2));
+CREATE TABLE main.movement(
+    movement_id bigint PRIMARY KEY,
+    car_plate_num text,
+    ride bigint,
+    event text,
+    dt timestamp);
+'''
+
+# Схема DWH восстановлена по запросам transform_and_load.py и report.py
+DWH_DDL = '''
+CREATE SCHEMA dwh_voronezh;
+CREATE TABLE dwh_voronezh.dim_clients(
+    phone_num text PRIMARY KEY,
+    start_dt date,
+    card_num text,
+    deleted_flag char(1),
+    end_dt date);
+CREATE TABLE dwh_voronezh.dim_cars(
+    plate_num text PRIMARY KEY,
+    start_dt date,
+    model_name text,
+    revision_dt date,
+    deleted_flag char(1),
+    end_dt date);
+CREATE TABLE dwh_voronezh.dim_drivers(
+    personnel_num text PRIMARY KEY,
+    start_dt date,
+    last_name text,
+    first_name text,
+    middle_name text,
+    birth_dt date,
+    card_num text,
+    driver_license_num text,
+    driver_license_dt date,
+    deleted_flag char(1),
+    end_dt date);
+CREATE TABLE dwh_voronezh.fact_waybills(
+    waybill_num text PRIMARY KEY,
+    driver_pers_num text,
+    car_plate_num text,
+    work_start_dt timestamp,
+    work_end_dt timestamp,
+    issue_dt timestamp);
+CREATE TABLE dwh_voronezh.fact_rides(
+    ride_id bigint PRIMARY KEY,
+    point_from_txt text,
+    point_to_txt text,
+    distance_val numeric(5, 2),
+    price_amt numeric(7, 2),
+    client_phone_num text,
+    driver_pers_num text,
+    car_plate_num text,
+    ride_start_dt timestamp,
+    ride_end_dt timestamp,
+    ride_arrival_dt timestamp);
+CREATE TABLE dwh_voronezh.fact_payments(
+    transaction_id bigserial PRIMARY KEY,
+    card_num text,
+    transaction_amt numeric(7, 2),
+    transaction_dt timestamp,
+    UNIQUE (card_num, transaction_dt, transaction_amt));
+CREATE TABLE dwh_voronezh.rep_drivers_payments(
+    personnel_num text,
+    last_name text,
+    first_name text,
+    middle_name text,
+    card_num text,
+    report_dt date,
+    amount numeric);
+CREATE TABLE dwh_voronezh.rep_drivers_violations(
+    personnel_num text,
+    ride bigint,
+    speed numeric,
+    violations_cnt bigint);
+'''
+
+STREETS = ['ул. Ленина', 'ул. Кольцовская', 'пр. Революции', 'ул. Плехановская', 'Московский пр.',
+           'ул. 20-летия Октября', 'Ленинский пр.', 'ул. Лизюкова']
+
+
+def generate_data(movement_rows: int, days: int, seed: int) -> dict:
+    """Генерация синтетических таблиц источника, путевых листов и транзакций (~3 события movement на поездку)"""
+    rng = np.random.default_rng(seed)
+    rides_count = max(1, movement_rows // 3)
+    cars_count = max(10, rides_count // 200)
+    clients_count = max(10, rides_count // 20)
+    start = pd.Timestamp(datetime.date.today()) - pd.Timedelta(days=days)
+
+    # Машины и водители: за каждой машиной закреплен один водитель с ежедневным путевым листом
+    car_ids = np.arange(cars_count)
+    plates = pd.Series(car_ids).map('X{:06d}'.format)
+    licenses = pd.Series(car_ids).map('77AB{:06d}'.format)
+    car_pool = pd.DataFrame({'plate_num': plates,
+                             'model': rng.choice(['Lada Vesta', 'Kia Rio', 'Hyundai Solaris', 'Skoda Rapid'],
+                                                 cars_count),
+                             'revision_dt': (start - pd.to_timedelta(rng.integers(0, 365, cars_count), 'D')).date,
+                             'register_dt': start - pd.to_timedelta(rng.integers(365, 3650, cars_count), 'D'),
+                             'finished_flg': 'N',
+                             'update_dt': start})
+    drivers = pd.DataFrame({'driver_license': licenses,
+                            'first_name': 'Иван',
+                            'last_name': pd.Series(car_ids).map('Иванов{}'.format),
+                            'middle_name': 'Иванович',
+                            'driver_valid_to': (start + pd.Timedelta(days=3650)).date(),
+                            'card_num': pd.Series(car_ids).map(lambda i: f'5000 0000 {i // 10000:04d} {i % 10000:04d}'),
+                            'update_dt': start,
+                            'birth_dt': (start - pd.to_timedelta(rng.integers(8000, 20000, cars_count), 'D')).date})
+
+    # Поездки упорядочены по времени заказа; около 10% поездок отменяются
+    order_dt = np.sort(start.value + rng.integers(0, (days * 86400 - 4 * 3600) * 10 ** 9, rides_count))
+    clients = rng.integers(0, clients_count, rides_count)
+    distance = np.round(rng.uniform(1, 50, rides_count), 2)
+    rides = pd.DataFrame({'ride_id': np.arange(1, rides_count + 1),
+                          'dt': pd.to_datetime(order_dt),
+                          'client_phone': pd.Series(clients).map('+7-9{:09d}'.format),
+                          'card_num': pd.Series(clients).map(lambda i: f'4000 0000 {i // 10000:04d} {i % 10000:04d}'),
+                          'point_from': [f'{STREETS[i % len(STREETS)]}, {i % 97 + 1}' for i in
+                                         rng.integers(0, 10 ** 6, rides_count)],
+                          'point_to': [f'{STREETS[i % len(STREETS)]}, {i % 89 + 1}' for i in
+                                       rng.integers(0, 10 ** 6, rides_count)],
+                          'distance': distance,
+                          'price': np.round(100 + distance * 25, 2)})
+
+    # События поездки: подача машины, начало и окончание (или отмена)
+    ride_car = rng.integers(0, cars_count, rides_count)
+    cancelled = rng.random(rides_count) < 0.1
+    ready = rides['dt'] + pd.to_timedelta(rng.integers(300, 900, rides_count), 's')
+    begin = ready + pd.to_timedelta(rng.integers(60, 300, rides_count), 's')
+    # Скорость 20-110 км/ч: часть поездок попадает в отчет о нарушениях
+    end = begin + pd.to_timedelta(distance / rng.uniform(20, 110, rides_count) * 3600, 's').round('s')
+
+    finished = ~cancelled
+    movement = pd.concat([
+        pd.DataFrame({'ride': rides['ride_id'], 'event': 'READY', 'dt': ready, 'car': ride_car}),
+        pd.DataFrame({'ride': rides['ride_id'][finished], 'event': 'BEGIN', 'dt': begin[finished],
+                      'car': ride_car[finished]}),
+        pd.DataFrame({'ride': rides['ride_id'][finished], 'event': 'END', 'dt': end[finished],
+                      'car': ride_car[finished]}),
+        pd.DataFrame({'ride': rides['ride_id'][cancelled], 'event': 'CANCEL', 'dt': begin[cancelled],
+                      'car': ride_car[cancelled]}),
+    ], ignore_index=True).sort_values('dt', kind='stable', ignore_index=True)
+    movement.insert(0, 'movement_id', np.arange(1, len(movement) + 1))
+    movement.insert(1, 'car_plate_num', plates.to_numpy()[movement.pop('car').to_numpy()])
+
+    # Путевые листы: по одному на машину и день, выдаются накануне вечером
+    day, car = np.divmod(np.arange(days * cars_count), cars_count)
+    work_start = start + pd.to_timedelta(day, 'D')
+    waybills = pd.DataFrame({'number': [f'{d:04d}{c:06d}' for d, c in zip(day, car)],
+                             'issuedt': work_start - pd.Timedelta(hours=4),
+                             'car': plates.to_numpy()[car],
+                             'license': licenses.to_numpy()[car],
+                             'start': work_start,
+                             'stop': work_start + pd.Timedelta(hours=23, minutes=59, seconds=59),
+                             'day': day})
+
+    # Транзакции: оплата каждой завершенной поездки картой клиента
+    payments = pd.DataFrame({'date': end[finished] + pd.Timedelta(minutes=1),
+                             'card': rides['card_num'][finished].str.replace(' ', ''),
+                             'amount': rides['price'][finished]})
+
+    return {'main.car_pool': car_pool, 'main.drivers': drivers, 'main.rides': rides, 'main.movement': movement,
+            'waybills': waybills, 'payments': payments}
+
+
+def write_ftp_files(root: str, data: dict, waybills_per_file: int) -> dict:
+    """Запись путевых листов (XML) и транзакций (TSV) в папки FTP-сервера, возвращает число файлов"""
+    counts = {}
+    for folder in ['waybills', 'payments']:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    waybills = data['waybills']
+    files = 0
+    for (day, chunk), group in waybills.groupby([waybills['day'], np.arange(len(waybills)) // waybills_per_file]):
+        body = ''.join(f'<waybill number="{row.number}" issuedt="{row.issuedt:%Y-%m-%dT%H:%M:%S}">'
+                       f'<car>{row.car}</car><driver><license>{row.license}</license></driver>'
+                       f'<period><start>{row.start:%Y-%m-%dT%H:%M:%S}</start>'
+                       f'<stop>{row.stop:%Y-%m-%dT%H:%M:%S}</stop></period></waybill>'
+                       for row in group.itertuples(index=False))
+        with open(os.path.join(root, 'waybills', f'waybill_{day:04d}_{chunk:04d}.xml'), 'w') as xml_file:
+            xml_file.write(f'<?xml version="1.0" encoding="utf-8"?><waybills>{body}</waybills>')
+        files += 1
+    counts['waybills'] = files
+
+    payments = data['payments']
+    files = 0
+    for day, group in payments.groupby(payments['date'].dt.date):
+        group.to_csv(os.path.join(root, 'payments', f'transactions_{day:%Y%m%d}.txt'), sep='\t',
+                     header=False, index=False, date_format='%d.%m.%Y %H:%M:%S')
+        files += 1
+    counts['payments'] = files
+    return counts
+
+
+def admin_connection():
+    """Соединение с локальным PostgreSQL для создания и удаления временных баз"""
+    connection = psycopg2.connect(database='postgres', **BENCH_POSTGRES)
+    connection.autocommit = True
+    return connection
+
+
+def recreate_databases() -> None:
+    """Пересоздание баз источника и DWH"""
+    connection = admin_connection()
+    with connection.cursor() as cursor:
+        for name in [SOURCE_DB, DWH_DB]:
+            cursor.execute(f'DROP DATABASE IF EXISTS {name}')
+            cursor.execute(f'CREATE DATABASE {name}')
+        # Отчеты обращаются к таблицам DWH без указания схемы
+        cursor.execute(f'ALTER DATABASE {DWH_DB} SET search_path TO dwh_voronezh, public')
+    connection.close()
+
+
+def drop_databases() -> None:
+    """Удаление временных баз"""
+    connection = admin_connection()
+    with connection.cursor() as cursor:
+        for name in [SOURCE_DB, DWH_DB]:
+            cursor.execute(f'DROP DATABASE IF EXISTS {name}')
+    connection.close()
+
+
+def load_databases(data: dict, chunk_size: int = 500000) -> None:
+    """Создание схем и загрузка синтетических таблиц в базу источника через COPY"""
+    connection = psycopg2.connect(database=DWH_DB, **BENCH_POSTGRES)
+    with connection.cursor() as cursor:
+        cursor.execute(DWH_DDL)
+    connection.commit()
+    connection.close()
+
+    connection = psycopg2.connect(database=SOURCE_DB, **BENCH_POSTGRES)
+    with connection.cursor() as cursor:
+        cursor.execute(SOURCE_DDL)
+        for table in ['main.car_pool', 'main.drivers', 'main.rides', 'main.movement']:
+            frame = data[table]
+            for start in range(0, len(frame), chunk_size):
+                buffer = io.StringIO()
+                frame.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT csv)', buffer)
+        cursor.execute('ANALYZE')
+    connection.commit()
+    connection.close()
+
+
+def make_certificate(workdir: str) -> str:
+    """Самоподписанный сертификат для FTPS-сервера"""
+    certfile = os.path.join(workdir, 'ftps.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', certfile, '-out', certfile],
+                   check=True, capture_output=True)
+    return certfile
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_ftps(root: str, certfile: str, port: int):
+    """Запуск FTPS-сервера (pyftpdlib) в фоновом потоке"""
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import TLS_FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWORD, root, perm='elr')
+
+    handler = type('BenchFTPHandler', (TLS_FTPHandler,), {})
+    handler.certfile = certfile
+    handler.authorizer = authorizer
+    handler.tls_control_required = True
+    handler.tls_data_required = True
+
+    server = ThreadedFTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+    thread.start()
+    return server
+
+
+def etl_environment(workdir: str, ftp_port: int, phase: str) -> dict:
+    """Параметры ETL-процесса (переменные окружения) для временных баз и FTPS-сервера"""
+    return {
+        'POSTGRES_USER': BENCH_POSTGRES['user'], 'POSTGRES_PASSWORD': BENCH_POSTGRES['password'],
+        'POSTGRES_HOST': BENCH_POSTGRES['host'], 'POSTGRES_PORT': str(BENCH_POSTGRES['port']),
+        'POSTGRES_DB': SOURCE_DB, 'POSTGRES_MODE': 'prefer',
+        'DWH_POSTGRES_USER': BENCH_POSTGRES['user'], 'DWH_POSTGRES_PASSWORD': BENCH_POSTGRES['password'],
+        'DWH_POSTGRES_DB': DWH_DB,
+        'FTP_HOST': '127.0.0.1', 'FTP_PORT': str(ftp_port), 'FTP_LOGIN': FTP_USER, 'FTP_PASSWORD': FTP_PASSWORD,
+        'METRICS_LOG': os.path.join(workdir, f'metrics_{phase}.jsonl'),
+        'METRICS_PROM': os.path.join(workdir, f'metrics_{phase}.prom'),
+    }
+
+
+def run_etl(workdir: str, environment: dict) -> None:
+    """Один цикл ETL-процесса и отчетов (выполняется в отдельном процессе)"""
+    # Параметры читаются при импорте модулей: рабочая папка без .env, конфигурация - из окружения
+    os.chdir(workdir)
+    os.environ.update(environment)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from extract import extract_data
+    from logger import stage
+    from report import make_reports
+    from transform_and_load import transform_and_load_data
+
+    transform_and_load_data(extract_data())
+    with stage('make_reports'):
+        make_reports()
+
+
+def run_phase(workdir: str, ftp_port: int, phase: str) -> list:
+    """Запуск цикла в новом процессе: пиковая память не включает генерацию данных и прошлые циклы"""
+    environment = etl_environment(workdir, ftp_port, phase)
+    process = multiprocessing.get_context('spawn').Process(target=run_etl, args=(workdir, environment))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Цикл {phase} завершился с кодом {process.exitcode}')
+
+    with open(environment['METRICS_LOG']) as metrics_log:
+        return [json.loads(line) for line in metrics_log]
+
+
+def summarize(records: list) -> dict:
+    """Сводка по основным этапам: время, строк в секунду, пиковая память"""
+    summary = {}
+    for record in records:
+        if record['stage'] in TOP_STAGES:
+            summary[record['stage']] = {key: record[key] for key in
+                                        ['seconds', 'rows_in', 'rows_out', 'rows_per_s', 'round_trips', 'bytes',
+                                         'peak_rss_mb']}
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_volume(movement_rows: int, args) -> dict:
+    """Замер для одного объема данных: первичная загрузка и повторный (пустой инкрементальный) цикл"""
+    workdir = tempfile.mkdtemp(prefix=f'etl_bench_{movement_rows}_')
+    ftp_root = os.path.join(workdir, 'ftp')
+    server = None
+    try:
+        print(f'Генерация данных: {movement_rows} строк movement')
+        data = generate_data(movement_rows, args.days, args.seed)
+        files = write_ftp_files(ftp_root, data, args.waybills_per_file)
+        volumes = {table: len(frame) for table, frame in data.items()}
+        volumes.update({f'{folder}_files': count for folder, count in files.items()})
+
+        recreate_databases()
+        load_databases(data)
+        del data
+
+        ftp_port = free_port()
+        server = start_ftps(ftp_root, args.certfile or make_certificate(workdir), ftp_port)
+
+        phases = {}
+        for phase in ['initial', 'repeat']:
+            print(f'Цикл {phase}')
+            records = run_phase(workdir, ftp_port, phase)
+            phases[phase] = {'summary': summarize(records), 'stages': records}
+            for name, metrics in phases[phase]['summary'].items():
+                print(f"    {name}: {metrics['seconds']:.2f} с, {metrics['rows_per_s']} строк/с, "
+                      f"{metrics['peak_rss_mb']} МБ")
+
+        return {'movement_rows': movement_rows, 'volumes': volumes, 'phases': phases}
+
+    finally:
+        if server:
+            server.close_all()
+        if not args.keep:
+            drop_databases()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(previous: dict, current: dict) -> None:
+    """Сравнение времени этапов с прошлым результатом (отношение больше 1 - замедление)"""
+    before = {run['movement_rows']: run for run in previous['runs']}
+    for run in current['runs']:
+        if run['movement_rows'] not in before:
+            continue
+        for phase, results in run['phases'].items():
+            old = before[run['movement_rows']]['phases'].get(phase, {}).get('summary', {})
+            for name, metrics in results['summary'].items():
+                if name in old and old[name]['seconds']:
+                    print(f"{run['movement_rows']:>10} {phase:<8} {name:<25} "
+                          f"{old[name]['seconds']:>9.2f} с -> {metrics['seconds']:>9.2f} с "
+                          f"(x{metrics['seconds'] / old[name]['seconds']:.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Нагрузочный тест ETL-процесса на синтетических данных')
+    parser.add_argument('--movement-rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='объемы таблицы movement (например, 10000 100000 10000000)')
+    parser.add_argument('--days', type=int, default=30, help='период данных в днях')
+    parser.add_argument('--waybills-per-file', type=int, default=500, help='путевых листов в одном XML-файле')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--certfile', help='сертификат FTPS-сервера (по умолчанию создается через openssl)')
+    parser.add_argument('--output', help='файл результата (по умолчанию bench_results/<время>_<коммит>.json)')
+    parser.add_argument('--compare', help='прошлый результат для сравнения')
+    parser.add_argument('--keep', action='store_true', help='не удалять временные базы и файлы')
+    args = parser.parse_args()
+
+    result = {'commit': git_commit(), 'started_at': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'cpu_count': os.cpu_count(), 'days': args.days, 'seed': args.seed,
+              'runs': [run_volume(movement_rows, args) for movement_rows in args.movement_rows]}
+
+    output = args.output or os.path.join('bench_results', f"{datetime.datetime.now():%Y%m%d%H%M%S}_"
+                                                          f"{result['commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as result_file:
+        json.dump(result, result_file, indent=2, default=str)
+    print(f'Результат сохранен: {output}')
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), result)
@@ -0,0 +1,205 @@
+import json
+import os
+import pandas as pd
+from psycopg2 import extras
+from config import get_config
+from session import execute_prepared
+
+CONFIG = get_config()
+
+# Время хранения незавершенной поездки в буфере (ч), после него поездка удаляется
+PENDING_RIDE_TTL_HOURS = float(CONFIG.get('PENDING_RIDE_TTL_HOURS', 72))
+
+# Значения по умолчанию для первого запуска
+DEFAULT_CHECKPOINTS = {
+    'main.car_pool': {'update_dt': '1970-01-01 00:00:00.000000'},
+    'main.drivers': {'update_dt': '1970-01-01 00:00:00.000000'},
+    'main.rides': {'id': 0},
+    'main.movement': {'id': 0},
+    'ftp:waybills': {},
+    'ftp:payments': {},
+}
+
+# Таблицы состояния проверяются один раз за время работы процесса
+_tables_ready = False
+
+
+def ensure_checkpoint_tables(cursor) -> None:
+    """Создание таблиц состояния инкрементальной загрузки в DWH (один раз за процесс)"""
+    global _tables_ready
+    if _tables_ready:
+        return
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS dwh_voronezh.etl_checkpoints(
+                      source text PRIMARY KEY,
+                      value jsonb NOT NULL,
+                      update_dt timestamp NOT NULL DEFAULT now())''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS dwh_voronezh.etl_pending_rides(
+                      ride_id bigint PRIMARY KEY,
+                      update_dt timestamp NOT NULL DEFAULT now())''')
+    # Буфер незавершенных поездок: строка из rides, уже полученные события movement и признак
+    # события окончания (такая поездка ждет путевого листа).
+    # ALTER TABLE блокирует таблицу целиком, поэтому выполняется, только если колонок еще нет
+    cursor.execute('''SELECT column_name FROM information_schema.columns
+                      WHERE table_schema = 'dwh_voronezh' AND table_name = 'etl_pending_rides'
+                        AND column_name IN ('ride', 'movement', 'first_seen_dt', 'ended')''')
+    columns = {name for name, in cursor.fetchall()}
+    if len(columns) < 4:
+        cursor.execute('''ALTER TABLE dwh_voronezh.etl_pending_rides
+                          ADD COLUMN IF NOT EXISTS ride jsonb,
+                          ADD COLUMN IF NOT EXISTS movement jsonb,
+                          ADD COLUMN IF NOT EXISTS first_seen_dt timestamp NOT NULL DEFAULT now(),
+                          ADD COLUMN IF NOT EXISTS ended boolean NOT NULL DEFAULT false''')
+    if 'ended' not in columns:
+        # Признак для поездок, сохраненных в буфер до его появления
+        cursor.execute('''UPDATE dwh_voronezh.etl_pending_rides SET ended = true
+                          WHERE ride IS NOT NULL
+                            AND EXISTS (SELECT 1 FROM jsonb_array_elements(movement) AS event
+                                        WHERE event->>'event' IN ('END', 'CANCEL'))''')
+    # Изменения схемы фиксируются сразу, чтобы признак не остался установленным после отката транзакции
+    cursor.connection.commit()
+    _tables_ready = True
+
+
+def legacy_checkpoints(log_dir: str = 'log') -> tuple:
+    """Перенос состояния из log/*.txt (используется один раз, пока таблица состояния пуста)"""
+    checkpoints = {}
+
+    def read(filename):
+        try:
+            with open(os.path.join(log_dir, filename), 'r') as log_data:
+                return log_data.read()
+        except FileNotFoundError:
+            return None
+
+    dt_last = read('log.txt')
+    if dt_last:
+        checkpoints['main.car_pool'] = {'update_dt': dt_last.strip()}
+        checkpoints['main.drivers'] = {'update_dt': dt_last.strip()}
+    for source, filename in [('main.rides', 'log_rides.txt'), ('main.movement', 'log_movement.txt')]:
+        id_last = read(filename)
+        if id_last:
+            checkpoints[source] = {'id': int(id_last.strip())}
+    manifest = read('ftp_manifest.json')
+    if manifest:
+        checkpoints.update({f'ftp:{key}': value for key, value in json.loads(manifest).items()})
+
+    unfinished = read('log_movement_unfinished.txt') or ''
+    pending = sorted({int(ride_id) for ride_id in unfinished.split('\n') if ride_id.strip()})
+    return checkpoints, pending
+
+
+def read_checkpoints(cursor) -> tuple:
+    """Получение сохраненных контрольных точек и списка незавершенных поездок"""
+    ensure_checkpoint_tables(cursor)
+    execute_prepared(cursor, 'read_checkpoints', "SELECT source, value FROM dwh_voronezh.etl_checkpoints")
+    stored = dict(cursor.fetchall())
+    # Повторно из источника извлекаются только поездки без сохраненных данных (перенесенные из log-файлов)
+    execute_prepared(cursor, 'read_pending_ids',
+                     "SELECT ride_id FROM dwh_voronezh.etl_pending_rides WHERE ride IS NULL AND movement IS NULL")
+    pending = [ride_id for ride_id, in cursor.fetchall()]
+
+    if not stored:
+        legacy, legacy_pending = legacy_checkpoints()
+        stored, pending = legacy, pending or legacy_pending
+
+    return dict(DEFAULT_CHECKPOINTS, **stored), pending
+
+
+def write_checkpoints(cursor, checkpoints: dict) -> None:
+    """Сохранение контрольных точек (в транзакции загрузки соответствующих данных)"""
+    if checkpoints:
+        extras.execute_values(cursor, '''INSERT INTO dwh_voronezh.etl_checkpoints(source, value) VALUES %s
+                                         ON CONFLICT (source) DO UPDATE
+                                         SET value = EXCLUDED.value, update_dt = now()''',
+                              [(source, json.dumps(value, default=str)) for source, value in checkpoints.items()])
+
+
+def to_records(frame: pd.DataFrame) -> list:
+    """Строки ДатаФрейма в виде словарей для хранения в jsonb (NaN/NaT заменяются на None)"""
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+def incoming_ride_ids(rides: pd.DataFrame, movement: pd.DataFrame) -> list:
+    """Поездки, по которым получены новые строки rides или события movement"""
+    ride_ids = set(rides['ride_id']) if not rides.empty else set()
+    if not movement.empty:
+        ride_ids |= set(movement['ride'])
+    return sorted(int(ride_id) for ride_id in ride_ids)
+
+
+def merge_pending_rides(cursor, rides: pd.DataFrame, movement: pd.DataFrame, partition: bool = False) -> tuple:
+    """Объединение новых строк rides и movement с буфером незавершенных поездок
+    (partition - для части backfill: только поездки этой части, без удаления просроченных
+    и поездок, ожидающих путевого листа, - их обрабатывает согласование после загрузки частей)"""
+    # Поездки, которые не завершились за PENDING_RIDE_TTL_HOURS, удаляются из буфера
+    if not partition:
+        execute_prepared(cursor, 'expire_pending_rides', '''DELETE FROM dwh_voronezh.etl_pending_rides
+                                                           WHERE first_seen_dt < now() - %s::float8 * interval '1 hour'
+                                                           RETURNING ride_id''', (PENDING_RIDE_TTL_HOURS,))
+        expired = [ride_id for ride_id, in cursor.fetchall()]
+        if expired:
+            print(f"Поездки удалены из буфера по истечении срока: {len(expired)}: {', '.join(map(str, expired))}")
+
+    # Из буфера читаются только поездки с новыми данными и поездки, ожидающие путевого листа
+    execute_prepared(cursor, 'read_pending_rides', '''SELECT ride, movement FROM dwh_voronezh.etl_pending_rides
+                                                     WHERE ride_id = ANY(%s::bigint[]) OR (ended AND %s)''',
+                     (incoming_ride_ids(rides, movement), not partition))
+    buffered = cursor.fetchall()
+    if not buffered:
+        return rides, movement
+
+    buffered_rides = pd.DataFrame([ride for ride, _ in buffered if ride])
+    buffered_movement = pd.DataFrame([event for _, events in buffered for event in events or []])
+    for frame in [buffered_rides, buffered_movement]:
+        if not frame.empty:
+            frame['dt'] = pd.to_datetime(frame['dt'])
+
+    # К буферу добавляются только новые строки; данные из источника имеют приоритет
+    rides = pd.concat([buffered_rides, rides], ignore_index=True)
+    movement = pd.concat([buffered_movement, movement], ignore_index=True)
+    if not rides.empty:
+        rides = rides.drop_duplicates('ride_id', keep='last')
+    if not movement.empty:
+        movement = movement.drop_duplicates('movement_id', keep='last')
+    return rides, movement
+
+
+def write_pending_rides(cursor, rides: pd.DataFrame, movement: pd.DataFrame, loaded: list,
+                        unfinished: list, changed: list) -> None:
+    """Обновление буфера: загруженные поездки удаляются, незавершенные сохраняются вместе с событиями
+    (перезаписываются только поездки из changed - с новыми строками rides или событиями movement)"""
+    execute_prepared(cursor, 'delete_pending_rides',
+                     "DELETE FROM dwh_voronezh.etl_pending_rides WHERE ride_id = ANY(%s::bigint[])",
+                     ([int(ride_id) for ride_id in loaded],))
+
+    # В буфер попадают незавершенные поездки и события поездок, строка которых из rides еще не получена
+    ride_ids = set(int(ride_id) for ride_id in unfinished)
+    if not movement.empty:
+        known = set(rides['ride_id']) if not rides.empty else set()
+        ride_ids |= {int(ride_id) for ride_id in movement['ride'].unique() if ride_id not in known}
+    ride_ids -= {int(ride_id) for ride_id in loaded}
+    ride_ids &= set(changed)
+    if not ride_ids:
+        return
+
+    ride_rows = {int(row['ride_id']): row for row in to_records(rides)} if not rides.empty else {}
+    events = {}
+    if not movement.empty:
+        pending_movement = movement[movement['ride'].isin(ride_ids)]
+        for row in to_records(pending_movement):
+            events.setdefault(int(row['ride']), []).append(row)
+
+    # first_seen_dt при обновлении не меняется - от него отсчитывается срок хранения.
+    # Поездка со строкой rides и событием окончания не загружена из-за водителя - она перечитывается каждый запуск
+    extras.execute_values(cursor, '''INSERT INTO dwh_voronezh.etl_pending_rides(ride_id, ride, movement, ended)
+                                     VALUES %s
+                                     ON CONFLICT (ride_id) DO UPDATE
+                                     SET ride = EXCLUDED.ride, movement = EXCLUDED.movement, ended = EXCLUDED.ended,
+                                         update_dt = now()''',
+                          [(ride_id,
+                            json.dumps(ride_rows.get(ride_id), default=str) if ride_id in ride_rows else None,
+                            json.dumps(events.get(ride_id, []), default=str),
+                            ride_id in ride_rows and any(event['event'] in ('END', 'CANCEL')
+                                                         for event in events.get(ride_id, [])))
+                           for ride_id in ride_ids])
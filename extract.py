@@ -1,13 +1,25 @@
 import datetime
 import ftplib
+import io
+import contextvars
+import multiprocessing
+import numpy as np
 import os
 import pandas as pd
-import psycopg2
-import sys
+import queue
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
 from psycopg2 import Error
+from psycopg2.extensions import AsIs, adapt, register_adapter
+from checkpoint import read_checkpoints
 from config import get_config
-from logger import logger
+from landing import LANDING_DIR, write_batch
+from logger import count, log, logger, set_label
+from session import get_pool
 
 # Установка пути проекта
 norm_path = os.getcwd()
@@ -18,156 +30,245 @@ CONFIG = get_config()
 DB_TABLE_NAMES = ['main.car_pool', 'main.rides', 'main.movement', 'main.drivers']
 FTP_TABLE_NAMES = ['waybills', 'payments']
 
+# Параметры потокового извлечения: число строк за один запрос к серверному курсору и размер пакета
+ITERSIZE = int(CONFIG.get('EXTRACT_ITERSIZE', 2000))
+BATCH_SIZE = int(CONFIG.get('EXTRACT_BATCH_SIZE', 10000))
 
-@logger
+# Способ извлечения: 'cursor' (серверный курсор) или 'copy' (COPY ... TO STDOUT в формате CSV);
+# при заданной EXTRACT_STAGING_DIR результат COPY сначала пишется в файл на диске
+EXTRACT_BACKEND = CONFIG.get('EXTRACT_BACKEND', 'cursor')
+EXTRACT_STAGING_DIR = CONFIG.get('EXTRACT_STAGING_DIR')
+
+# Параметры скачивания с FTP: размер пула сессий, число попыток и базовая задержка между ними (с)
+FTP_POOL_SIZE = int(CONFIG.get('FTP_POOL_SIZE', 4))
+FTP_RETRIES = int(CONFIG.get('FTP_RETRIES', 3))
+FTP_BACKOFF = float(CONFIG.get('FTP_BACKOFF', 1.0))
+
+# Поля путевого листа и параметры параллельного разбора XML-файлов
+WAYBILL_FIELDS = ['number', 'issuedt', 'car', 'license', 'start', 'stop']
+WAYBILL_PARSE_WORKERS = int(CONFIG.get('WAYBILL_PARSE_WORKERS', os.cpu_count() or 1))
+WAYBILL_PARALLEL_THRESHOLD = int(CONFIG.get('WAYBILL_PARALLEL_THRESHOLD', 200))
+
+# OID типов PostgreSQL, которые нужно явно разобрать при чтении CSV
+DATE_OIDS = {1082, 1114, 1184}
+TEXT_OIDS = {25, 1042, 1043}
+
+
+# Адаптеры psycopg2 для типов numpy/pandas, чтобы значения из типизированных ДатаФреймов
+# передавались в SQL-запросы напрямую (NaN/NaT передаются как NULL)
+def adapt_numpy_float(value):
+    return AsIs('NULL') if np.isnan(value) else AsIs(repr(float(value)))
+
+
+def adapt_timestamp(value):
+    return AsIs('NULL') if pd.isna(value) else adapt(pd.Timestamp(value).to_pydatetime())
+
+
+register_adapter(np.int64, AsIs)
+register_adapter(np.int32, AsIs)
+register_adapter(np.float64, adapt_numpy_float)
+register_adapter(np.bool_, lambda value: AsIs(bool(value)))
+register_adapter(np.datetime64, adapt_timestamp)
+register_adapter(pd.Timestamp, adapt_timestamp)
+register_adapter(type(pd.NaT), lambda value: AsIs('NULL'))
+
+
+@log
 def connect_db(configs: dict, dwh=False) -> tuple:
     """Открытие соединения с postgreSQL"""
-    # Подключение к базе данных с помощью параметров
+    # Соединение берется из общего пула процесса (для источника и DWH - свои пулы)
     try:
         if not dwh:
-            connection = psycopg2.connect(user=configs['POSTGRES_USER'],
-                                          password=configs['POSTGRES_PASSWORD'],
-                                          host=configs['POSTGRES_HOST'],
-                                          port=configs['POSTGRES_PORT'],
-                                          database=configs['POSTGRES_DB'],
-                                          sslmode=configs['POSTGRES_MODE'])
+            params = dict(user=configs['POSTGRES_USER'],
+                          password=configs['POSTGRES_PASSWORD'],
+                          host=configs['POSTGRES_HOST'],
+                          port=configs['POSTGRES_PORT'],
+                          database=configs['POSTGRES_DB'],
+                          sslmode=configs['POSTGRES_MODE'])
         else:
-            connection = psycopg2.connect(user=configs['DWH_POSTGRES_USER'],
-                                          password=configs['DWH_POSTGRES_PASSWORD'],
-                                          host=configs['POSTGRES_HOST'],
-                                          port=configs['POSTGRES_PORT'],
-                                          database=configs['DWH_POSTGRES_DB'],
-                                          sslmode=configs['POSTGRES_MODE']
-                                          )
+            params = dict(user=configs['DWH_POSTGRES_USER'],
+                          password=configs['DWH_POSTGRES_PASSWORD'],
+                          host=configs['POSTGRES_HOST'],
+                          port=configs['POSTGRES_PORT'],
+                          database=configs['DWH_POSTGRES_DB'],
+                          sslmode=configs['POSTGRES_MODE'])
+        connection = get_pool(params).get()
         return (connection.cursor(), connection)
 
     except (Exception, Error) as error:
         print("Ошибка при работе с PostgreSQL", error)
 
 
-@logger
-def get_table(table_name, cursor) -> dict:
-    """Извлечение таблиц"""
+def id_watermark(table_name: str):
+    """Колонка id и колонка поездки для таблиц с инкрементом по id (movement и rides)"""
+    if 'movement' in table_name:
+        return 'movement_id', 'ride'
+    if 'rides' in table_name:
+        return 'ride_id', 'ride_id'
+    return None
 
-    # Переход в папку/создание папки log
-    try:
-        os.chdir('log')
 
-    except FileNotFoundError:
-        os.mkdir('log')
-        os.chdir('log')
+def build_query(table_name: str, checkpoint: dict, pending: bool = False) -> tuple:
+    """Построение SQL-запроса и его параметров для инкрементальной загрузки таблицы"""
 
     # Для таблиц car_pool и drivers инкрементальная загрузка осуществляется путем
-    # считывания времени последнего запуска программы и сравнивания с ним времени изменения строки в БД
-    if 'car_pool' in table_name or 'drivers' in table_name:
-        try:
+    # сравнивания времени изменения строки в БД с последним загруженным временем изменения
+    # Строки упорядочены по колонке контрольной точки: любой префикс результата можно загрузить
+    # и сдвинуть по нему контрольную точку (используется при потоковой загрузке пакетами)
+    if not id_watermark(table_name):
+        return f"select * from {table_name} where update_dt > %s order by update_dt", (checkpoint['update_dt'],)
 
-            with open('log.txt', mode='r') as log_data:
-                dt_last = log_data.readline()
+    # Для таблиц movement и rides инкрементальная загрузка осуществляется путем
+    # сравнивания id каждой строчки из данной таблицы с id последней обработанной строчки
+    id_column, ride_column = id_watermark(table_name)
 
-        except FileNotFoundError:
-            # При первом запуске кода время устанавливается по умолчанию
-            with open('log.txt', mode='w+') as log_data:
-                dt_last = '1970-01-01 00:00:00.000000'
-                log_data.write(dt_last)
+    # Незавершенные поездки хранятся в буфере DWH вместе со своими событиями и повторно не извлекаются;
+    # исключение - поездки без сохраненных данных (перенесенные из log-файлов), их id загружаются
+    # во временную таблицу pending_rides (см. stage_pending_rides)
+    if pending:
+        return (f"select * from {table_name} where {id_column} > %s "
+                f"or {ride_column} in (select ride_id from pending_rides) order by {id_column}", (checkpoint['id'],))
 
-        postgreSQL_select_Query = (f"select * from {table_name} where update_dt > '{dt_last}'")
-        os.chdir('..')
+    return f"select * from {table_name} where {id_column} > %s order by {id_column}", (checkpoint['id'],)
 
-    # Для таблицы movement инкрементальная загрузка осуществляется путем
-    # считывания id последней обработанной строчки и сравнивания с ним id каждой строчки из данной таблицы
-    elif 'movement' in table_name:
-        try:
-
-            with open('log_movement.txt', mode='r') as log_data:
-                id_last = log_data.readline()
 
-        except FileNotFoundError:
+def stage_pending_rides(connection, pending: list) -> bool:
+    """Загрузка id незавершенных поездок во временную таблицу соединения с источником"""
+    if not pending:
+        return False
 
-            # При первом запуске кода id устанавливается по умолчанию
-            with open('log_movement.txt', mode='w+') as log_data:
-                id_last = '0'
-                log_data.write(id_last)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("DROP TABLE IF EXISTS pending_rides")
+        cursor.execute("CREATE TEMP TABLE pending_rides (ride_id bigint PRIMARY KEY)")
+        cursor.copy_from(io.StringIO('\n'.join(map(str, pending))), 'pending_rides', columns=('ride_id',))
+    finally:
+        cursor.close()
+    return True
 
-        try:
-            # На этапе transform and load некоторые поездки могут быть не завершены к моменту запуска программы,
-            # информация о таких поездках хранится в файле log_movement_unfinished.txt
 
-            with open('log_movement_unfinished.txt', 'r') as original:
-                data_id = original.read()
-                data_id = tuple([int(i) for i in data_id.split('\n') if i != ''])
+def advance_checkpoint(table_name: str, checkpoint: dict, table: pd.DataFrame) -> dict:
+    """Новая контрольная точка таблицы по извлеченным строкам"""
+    if table.empty:
+        return checkpoint
 
-            postgreSQL_select_Query = (
-                f"select * from {table_name} where movement_id > '{id_last}' or ride in {data_id}")
+    if id_watermark(table_name):
+        id_column, _ = id_watermark(table_name)
+        return {'id': max(int(checkpoint['id']), int(table[id_column].max()))}
 
-        except:
-            postgreSQL_select_Query = (
-                f"select * from {table_name} where movement_id > '{id_last}'")
+    return {'update_dt': str(max(pd.Timestamp(checkpoint['update_dt']), pd.Timestamp(table['update_dt'].max())))}
 
-        os.chdir('..')
 
-    else:
-        # Для таблицы rides логика та же, что и для таблицы movement
-        try:
-            with open('log_rides.txt', mode='r') as log_data:
-                id_last = log_data.readline()
+def records_to_frame(records: list, column_names: list) -> pd.DataFrame:
+    """Построение типизированного ДатаФрейма из строк курсора (Decimal приводится к float)"""
+    return pd.DataFrame.from_records(records, columns=column_names, coerce_float=True)
 
-        except FileNotFoundError:
 
-            with open('log_rides.txt', mode='w+') as log_data:
-                id_last = '0'
-                log_data.write(id_last)
+def iter_table(table_name: str, connection, checkpoint: dict, pending: list = (),
+               batch_size: int = BATCH_SIZE) -> Iterator[pd.DataFrame]:
+    """Потоковое извлечение таблицы пакетами фиксированного размера"""
+    query, params = build_query(table_name, checkpoint, stage_pending_rides(connection, pending))
 
-        try:
-            with open('log_movement_unfinished.txt', 'r') as original:
-                data_id = original.read()
-                data_id = tuple([int(i) for i in data_id.split('\n') if i != ''])
+    # Именованный (серверный) курсор: строки передаются с сервера порциями по itersize,
+    # а не целиком, поэтому потребление памяти не зависит от размера таблицы
+    cursor = connection.cursor(name=f"extract_{table_name.split('.')[-1]}")
+    cursor.itersize = ITERSIZE
 
-            postgreSQL_select_Query = (
-                f"select * from {table_name} where ride_id > '{id_last}' or ride_id in {data_id}")
+    try:
+        cursor.execute(query, params)
+        column_names = None
+        batch = []
+
+        # Значения сохраняют типы psycopg2 (datetime, int, float, None), пакет упаковывается в ДатаФрейм
+        for row in cursor:
+            if column_names is None:
+                column_names = [desc[0] for desc in cursor.description]
+            batch.append(row)
+
+            if len(batch) == batch_size:
+                # Итерация по серверному курсору запрашивает строки порциями по itersize
+                count(rows_out=len(batch), round_trips=-(-len(batch) // ITERSIZE))
+                yield records_to_frame(batch, column_names)
+                batch = []
+
+        if batch:
+            count(rows_out=len(batch), round_trips=-(-len(batch) // ITERSIZE))
+            yield records_to_frame(batch, column_names)
 
-        except:
-            postgreSQL_select_Query = (f"select * from {table_name} where ride_id > '{id_last}'")
+    finally:
+        cursor.close()
 
-        os.chdir('..')
 
-    # Извлечение данных по SQL запросу, написанному выше
-    cursor.execute(postgreSQL_select_Query)
-    column_names = [desc[0] for desc in cursor.description]
-    table_records = cursor.fetchall()
-    table_list = []
-    table_records = [list(row) for row in table_records]
+def copy_table(table_name: str, connection, checkpoint: dict, pending: list = (),
+               staging_dir: str = None) -> pd.DataFrame:
+    """Извлечение таблицы через COPY ... TO STDOUT"""
+    query, params = build_query(table_name, checkpoint, stage_pending_rides(connection, pending))
+    cursor = connection.cursor()
 
-    # Упаковка полученных данных в словарь
-    for row in table_records:
-        for i in range(len(row)):
-            row[i] = str(row[i])
+    try:
+        # COPY не принимает параметры, поэтому они подставляются на стороне клиента
+        query = cursor.mogrify(query, params).decode()
+
+        # Типы колонок берутся из пустой выборки, чтобы CSV разбирался в те же типы, что и курсор
+        cursor.execute(f"select * from ({query}) as source_query limit 0")
+        date_columns = [desc.name for desc in cursor.description if desc.type_code in DATE_OIDS]
+        text_columns = {desc.name: str for desc in cursor.description if desc.type_code in TEXT_OIDS}
+
+        # NULL передается как \N, чтобы не путать его с пустой строкой
+        copy_query = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')"
+
+        if staging_dir:
+            os.makedirs(staging_dir, exist_ok=True)
+            source = os.path.join(staging_dir, f"{table_name.split('.')[-1]}.csv")
+            with open(source, 'wb') as staging_file:
+                cursor.copy_expert(copy_query, staging_file)
+        else:
+            source = io.BytesIO()
+            cursor.copy_expert(copy_query, source)
+            source.seek(0)
 
-        row = dict(zip(column_names, row))
-        table_list.append(row)
+    finally:
+        cursor.close()
 
-    os.chdir('log')
+    table = pd.read_csv(source, dtype=text_columns, parse_dates=date_columns, na_values=['\\N'],
+                        keep_default_na=False, true_values=['t'], false_values=['f'])
+    count(rows_out=len(table))
+    return table
 
-    # Записи последних id для таблиц movement и rides
-    if 'movement' in table_name:
-        if table_list != []:
-            with open('log_movement.txt', mode='w+') as log_data:
-                log_data.write(table_list[-1]['movement_id'])
 
-    elif 'rides' in table_name:
-        if table_list != []:
-            with open('log_rides.txt', mode='w+') as log_data:
-                log_data.write(table_list[-1]['ride_id'])
+@logger
+def get_table(table_name, cursor, checkpoint: dict, pending: list = ()) -> pd.DataFrame:
+    """Извлечение таблиц"""
+    set_label(table_name)
+    if EXTRACT_BACKEND == 'copy':
+        return copy_table(table_name, cursor.connection, checkpoint, pending, EXTRACT_STAGING_DIR)
 
-    os.chdir('..')
-    return table_list
+    # Пакетный режим загружает таблицу целиком, поэтому все пакеты и их объединение одновременно находятся в памяти.
+    # Память не растет с размером таблицы только в режиме PIPELINE_MODE=stream, где пакеты iter_table
+    # загружаются по мере извлечения
+    batches = list(iter_table(table_name, cursor.connection, checkpoint, pending))
+    return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
 
 
-@logger
+@log
 def disconnect_db(connection, cursor) -> None:
     """Закрытие соединения с PostgreSQL"""
+    # Соединение возвращается в пул, незавершенная транзакция откатывается
     cursor.close()
-    connection.close()
+    if getattr(connection, 'pool', None):
+        connection.pool.put(connection)
+    else:
+        connection.close()
+
+
+@contextmanager
+def db_session(dwh: bool = False):
+    """Соединение из пула на время блока: (cursor, connection)"""
+    cursor, connection = connect_db(CONFIG, dwh=dwh)
+    try:
+        yield cursor, connection
+    finally:
+        disconnect_db(connection, cursor)
 
 
 def connect_ftp():
@@ -190,185 +291,313 @@ def connect_ftp():
     return ftps
 
 
+class FtpsPool:
+    """Ограниченный пул переиспользуемых FTPS-сессий"""
+
+    def __init__(self, size: int = FTP_POOL_SIZE, retries: int = FTP_RETRIES, backoff: float = FTP_BACKOFF):
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        # Время скачивания каждого файла: папка, имя, секунды, байты, число попыток
+        self.timings = []
+        self.timings_lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        """Получение авторизованной сессии из пула (новая открывается, только если свободных нет)"""
+        with self.slots:
+            try:
+                ftps = self.sessions.get_nowait()
+            except queue.Empty:
+                ftps = connect_ftp()
+                if ftps is None:
+                    raise ftplib.Error('Не удалось подключиться к FTP-серверу')
+
+            try:
+                yield ftps
+            except Exception:
+                # После ошибки состояние сессии неизвестно, поэтому в пул она не возвращается
+                disconnect_ftp(ftps)
+                raise
+            self.sessions.put(ftps)
+
+    def download(self, folder: str, filename: str) -> bytes:
+        """Скачивание файла с повторными попытками и экспоненциальной задержкой"""
+        for attempt in range(1, self.retries + 1):
+            started = time.perf_counter()
+            try:
+                buffer = io.BytesIO()
+                with self.session() as ftps:
+                    ftps.retrbinary(f'RETR /{folder}/{filename}', buffer.write)
+
+                with self.timings_lock:
+                    self.timings.append((folder, filename, time.perf_counter() - started,
+                                         buffer.tell(), attempt))
+                count(bytes=buffer.tell())
+                return buffer.getvalue()
+
+            except ftplib.all_errors as error:
+                if attempt == self.retries:
+                    raise
+                print(f'Ошибка скачивания {folder}/{filename} (попытка {attempt}): {error}')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def close(self) -> None:
+        """Закрытие всех сессий пула"""
+        while True:
+            try:
+                disconnect_ftp(self.sessions.get_nowait())
+            except queue.Empty:
+                break
+
+
+def parse_list_line(line: str, now: datetime.datetime):
+    """Разбор строки вывода LIST (формат ls -l): имя, размер и время изменения"""
+    parts = line.split(maxsplit=8)
+    if len(parts) < 9 or not parts[0].startswith('-'):
+        return None
+
+    size, month, day, time_or_year, name = parts[4], parts[5], parts[6], parts[7], parts[8]
+    if ':' in time_or_year:
+        # Год не указывается для файлов моложе полугода: если дата с текущим годом
+        # оказывается в будущем, файл относится к прошлому году (переход через Новый год)
+        modified = datetime.datetime.strptime(f'{now.year} {month} {day} {time_or_year}', '%Y %b %d %H:%M')
+        if modified > now + datetime.timedelta(days=1):
+            modified = modified.replace(year=now.year - 1)
+    else:
+        modified = datetime.datetime.strptime(f'{time_or_year} {month} {day}', '%Y %b %d')
+
+    return name, int(size), modified.strftime('%Y%m%d%H%M%S')
+
+
+def list_ftp_files(ftps, folder: str) -> dict:
+    """Список файлов папки на FTP-сервере: {имя: [размер, время изменения]}"""
+    try:
+        # MLSD возвращает машиночитаемые факты за один запрос
+        return {name: [int(facts.get('size', -1)), facts.get('modify', '')[:14]]
+                for name, facts in ftps.mlsd(f'/{folder}', facts=['type', 'size', 'modify'])
+                if facts.get('type') == 'file'}
+
+    except ftplib.error_perm:
+        # Сервер не поддерживает MLSD - разбираем вывод LIST
+        listing = []
+        ftps.dir(f'/{folder}', listing.append)
+        now = datetime.datetime.now()
+        files = {}
+        for line in listing:
+            parsed = parse_list_line(line, now)
+            if parsed:
+                files[parsed[0]] = [parsed[1], parsed[2]]
+        return files
+
+
 @logger
-def get_ftps(ftp_data):
+def get_ftps(manifest: dict) -> tuple:
     """Получение данных с серверов FTP"""
     global FTP_TABLE_NAMES
-    ftps = connect_ftp()
+    pool = FtpsPool()
 
-    # Создания словаря для выгрузки данных
+    # Создания словаря для выгрузки данных; manifest - уже загруженные файлы по папкам
     ftp_data = {name: [] for name in FTP_TABLE_NAMES}
+    manifest = {key: dict(manifest.get(key, {})) for key in FTP_TABLE_NAMES}
+    listings = {}
+    new_files = []
+
+    with pool.session() as ftps:
+        for key in ftp_data.keys():
+            listings[key] = list_ftp_files(ftps, key)
+            ingested = manifest.get(key, {})
+
+            # Инкрементальный отбор файлов: скачиваются только новые файлы
+            # и файлы, у которых изменились размер или время изменения
+            for filename, facts in listings[key].items():
+                if ingested.get(filename) != facts:
+                    new_files.append((key, filename))
+
+    # Файлы из обеих папок скачиваются параллельно через общий пул сессий;
+    # каждая загрузка выполняется в копии контекста, чтобы байты учитывались в метриках этапа
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = {executor.submit(contextvars.copy_context().run, pool.download, key, filename): (key, filename)
+                       for key, filename in new_files}
 
-    for key in ftp_data.keys():
-
-        # Получение списка файлов в папке на FTP сервере
-        ftps.cwd(f'/{key}')
-        f = ftps.nlst()
-        flag = 0
-
-        os.chdir(norm_path)
-
-        try:
-            os.chdir('log')
-        except FileNotFoundError:
-            os.mkdir('log')
-            flag = 1
-
-        # Переключения вывода данных в консоль на вывод данных в файл и запись метаданных о FTP-файлах
-        stdoutOrigin = sys.stdout
-        sys.stdout = open(f"log_files_{key}.txt", "w")
-        ftps.dir()
-        sys.stdout.close()
-        sys.stdout = stdoutOrigin
-
-        if flag:
-            with open('log.txt', mode='w+') as log_data:
-                log_data.write('1970-01-01 00:00:00.000000')
-
-        # Получение времени последнего запуска программы
-        with open('log.txt', 'r') as log_data:
-            last_time = datetime.datetime.strptime(log_data.readline(), '%Y-%m-%d %H:%M:%S.%f')
-
-        year = datetime.date.today().year
-        os.chdir("../log")
-        new_files = []
-
-        with open(f"log_files_{key}.txt", "r") as file_s:
-            # Инкрементальный отбор файлов с FTP-сервера (сравнивается дата
-            # загрузки файла на сервер и датой последнего запуска программы)
-            for line in file_s:
-                line_time = ' '.join(line.split(' ')[-4:-1])
-                line_name = line.split(' ')[-1]
-                line_time = datetime.datetime.strptime(str(year) + ' ' + line_time, '%Y %b %d %H:%M')
-                if last_time < line_time:
-                    new_files.append(line_name[:-1])
-
-        os.chdir('..')
-
-        for i in range(len(f)):
-            filename = f[i]
-            if filename in new_files:
+            for future, (key, filename) in futures.items():
                 try:
-                    # Для каждого файла новое подключение (чтобы не потерять файлы из-за превышения времени запроса)
-                    ftps = connect_ftp()
-                    ftps.cwd(filename.split("_")[0] + 's')
-                    print('Открытие файла: ' + filename)
-                    get_ftp_data = []
+                    # Данные вносятся в словарь, где ключ - название папки на сервере
+                    ftp_data[key].append(future.result())
+                    manifest[key][filename] = listings[key][filename]
+                except ftplib.all_errors as error:
+                    failed.append(f'{key}/{filename}')
+                    print(f'Файл {key}/{filename} не скачан: {error}')
 
-                    def handle_binary(more_data):
-                        get_ftp_data.append(more_data)
+    finally:
+        # Отключение соединений
+        pool.close()
 
-                    # Скачивание файла
-                    resp = ftps.retrlines('RETR %s' % filename, callback=handle_binary)
-                    get_ftp_data = "; ".join(get_ftp_data)
+    # В манифесте остаются только файлы, которые еще есть на сервере;
+    # не скачанные файлы в него не попадают и будут запрошены при следующем запуске
+    manifest = {key: {filename: facts for filename, facts in manifest[key].items() if filename in listings[key]}
+                for key in listings}
 
-                    # Данные вносятся в словарь, где ключ - название папки на сервере
-                    ftp_data[filename.split('_')[0] + 's'].append(get_ftp_data)
-                except:
-                    # При ошибке скачивания повторно возвращаемся к этому же файлу
-                    i -= 1
+    if pool.timings:
+        seconds = sum(timing[2] for timing in pool.timings)
+        size = sum(timing[3] for timing in pool.timings)
+        print(f'Скачано файлов: {len(pool.timings)}, {size} байт, суммарно {seconds:.2f} с '
+              f'(в среднем {seconds / len(pool.timings):.3f} с на файл)')
+    if failed:
+        print(f'Не удалось скачать файлов: {len(failed)}: {", ".join(failed)}')
 
-    # Отключение соединения
-    disconnect_ftp(ftps)
-    return ftp_data
+    count(rows_out=sum(len(files) for files in ftp_data.values()))
+    return ftp_data, manifest
 
 
-@logger
+@log
 def disconnect_ftp(ftps) -> None:
     """Закрытие соединения с FTP"""
-    ftps.quit()
+    try:
+        ftps.quit()
+    except ftplib.all_errors:
+        # Сервер мог уже разорвать соединение - закрываем сокет без QUIT
+        ftps.close()
 
 
-def extract_data():
-    """Загрузка данных"""
-    print(f'Обновление данных {datetime.datetime.now()}')
+@logger
+def parse_payments(files: list) -> pd.DataFrame:
+    """Разбор файлов с транзакциями (TSV: дата, карта, сумма) в типизированный ДатаФрейм"""
+    # Все файлы разбираются одним вызовом read_csv по общему буферу байтов
+    payments = pd.read_csv(io.BytesIO(b'\n'.join(files)), sep='\t', header=None,
+                           names=['date', 'card', 'payment amount'],
+                           dtype={'date': str, 'card': str, 'payment amount': float},
+                           skip_blank_lines=True)
 
-    # Создаем словарь, ключи - имена таблиц, значения - пустые списки (в них будет записывать информация из БД)
-    tables_dict = {name: [] for name in DB_TABLE_NAMES}
+    payments['date'] = pd.to_datetime(payments['date'].str.strip(), format='%d.%m.%Y %H:%M:%S')
+    payments['card'] = payments['card'].str.strip()
+    count(rows_in=len(files), rows_out=len(payments))
+    return payments
 
-    # Подключаемся к БД
-    try:
-        cursor, connection = connect_db(CONFIG)
 
-        # Получаем данные из таблиц
-        for key in tables_dict.keys():
-            tables_dict[key] = get_table(key, cursor)
+def parse_waybill_file(content: bytes) -> list:
+    """Разбор одного XML-файла с путевыми листами (в файле может быть несколько листов)"""
+    records = []
+    for _, element in ET.iterparse(io.BytesIO(content), events=('end',)):
+        if element.tag != 'waybill':
+            continue
 
-    except (Exception, Error) as error:
-        print("Ошибка при работе с PostgreSQL", error)
+        def text(path):
+            value = element.findtext(path)
+            return value.strip() if value else None
 
-    finally:
-        if connection:
+        records.append((element.get('number'), element.get('issuedt'), text('.//car'),
+                        text('.//license'), text('.//start'), text('.//stop')))
+        # Разобранный лист больше не нужен - освобождаем память
+        element.clear()
 
-            # Отключаем соединение
-            disconnect_db(connection, cursor)
+    return records
 
-    # Создаем словарь для FTP, ключи - имена таблиц, значения - пустые списки (в них будет записывать информация с FTP)
-    ftp_data_processed = {name: [] for name in FTP_TABLE_NAMES}
 
-    # Получаем информацию с FTP сервера
-    ftp_data = get_ftps(ftp_data_processed)
+@logger
+def parse_waybills(files: list) -> pd.DataFrame:
+    """Разбор XML-файлов с путевыми листами в ДатаФрейм"""
+    # Большой объем файлов разбирается в пуле процессов, небольшой - в текущем процессе
+    if len(files) >= WAYBILL_PARALLEL_THRESHOLD and WAYBILL_PARSE_WORKERS > 1:
+        # Процессы запускаются через spawn: fork многопоточного процесса (конвейер, пул соединений)
+        # копирует занятые блокировки и открытые сокеты БД/FTP
+        with ProcessPoolExecutor(max_workers=WAYBILL_PARSE_WORKERS,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            chunksize = max(1, len(files) // (WAYBILL_PARSE_WORKERS * 4))
+            parsed = list(executor.map(parse_waybill_file, files, chunksize=chunksize))
+    else:
+        parsed = [parse_waybill_file(content) for content in files]
 
-    os.chdir("log")
+    waybills = pd.DataFrame.from_records([record for records in parsed for record in records],
+                                         columns=WAYBILL_FIELDS)
+    for column in ['issuedt', 'start', 'stop']:
+        waybills[column] = pd.to_datetime(waybills[column])
+    count(rows_in=len(files), rows_out=len(waybills))
+    return waybills
 
-    # Записываем время подключения к серверу
-    with open('log.txt', 'w+') as myfile:
-        myfile.write(str(datetime.datetime.now()))
 
-    # Создаем ДатаФрейм для payments
-    df_payments = pd.DataFrame()
+def extract_db_table(table_name: str, checkpoint: dict, pending: list = ()) -> pd.DataFrame:
+    """Извлечение одной таблицы по отдельному соединению"""
+    with db_session() as (cursor, connection):
+        return get_table(table_name, cursor, checkpoint, pending)
 
-    for key, value in ftp_data.items():
-        #  Вносим в ДатаФрейм для payments данные, скачанные с FTP
-        if key == 'payments' and value != []:
-            for file in value:
-                for string_dt in file.split(';'):
-                    df_payments = pd.concat([df_payments, pd.DataFrame(pd.Series(string_dt.split('\t'))).T])
 
-            df_payments.columns = ['date', 'card', 'payment amount']
+def read_state() -> tuple:
+    """Получение контрольных точек и незавершенных поездок из DWH"""
+    with db_session(dwh=True) as (cursor, connection):
+        checkpoints, pending = read_checkpoints(cursor)
+        connection.commit()
+        return checkpoints, pending
 
-            for index, row in df_payments.iterrows():
-                ftp_data_processed["payments"].append({"date": row[0], "card": row[1], "payment amount": row[2]})
 
-        # "Парсим" данные XML-файлов с FTP
-        elif key == 'waybills' and value != []:
-            for file in value:
-                tree = ET.fromstring(file.replace(';', ''))
+@logger
+def extract_data(db: bool = True, ftp: bool = True):
+    """Загрузка данных (db и ftp - какие источники опрашивать)"""
+    print(f'Обновление данных {datetime.datetime.now()}')
 
-                # Данные вносятся в словарь, где ключи - название колонки в будущем ДатаФрейме
-                info_dict = {}
+    # Контрольные точки хранятся в DWH и сохраняются вместе с загруженными данными
+    checkpoints, pending = read_state()
 
-                for info in tree.iter():
-                    line = list((info.tag, info.keys(), info.items(), info.text))
-                    info_dict[line[0]] = line[1:]
+    # Создаем словарь, ключи - имена таблиц, значения - пустые списки (в них будет записывать информация из БД)
+    tables_dict = {name: [] for name in DB_TABLE_NAMES}
 
-                del info_dict['driver']
-                del info_dict['period']
-                del info_dict['waybills']
+    # Создаем словарь для FTP, ключи - имена таблиц, значения - пустые списки (в них будет записывать информация с FTP)
+    ftp_data_processed = {name: [] for name in FTP_TABLE_NAMES}
+    manifest = {key: checkpoints[f'ftp:{key}'] for key in FTP_TABLE_NAMES}
+
+    # Таблицы БД извлекаются параллельно, каждая по своему соединению,
+    # одновременно с ними скачиваются файлы с FTP-сервера (в копиях контекста - для метрик этапа)
+    with ThreadPoolExecutor(max_workers=len(DB_TABLE_NAMES) + 1) as executor:
+        ftp_future = executor.submit(contextvars.copy_context().run, get_ftps, manifest) if ftp else None
+        db_futures = {key: executor.submit(contextvars.copy_context().run, extract_db_table, key, checkpoints[key],
+                                           pending if id_watermark(key) else ())
+                      for key in tables_dict.keys() if db}
+
+        # Получаем данные из таблиц; контрольная точка сдвигается только для успешно извлеченных таблиц
+        new_checkpoints = {}
+        for key, future in db_futures.items():
+            try:
+                tables_dict[key] = future.result()
+                new_checkpoints[key] = advance_checkpoint(key, checkpoints[key], tables_dict[key])
+            except (Exception, Error) as error:
+                print("Ошибка при работе с PostgreSQL", error)
+
+        # movement обрабатывается только вместе с rides, поэтому их контрольные точки сдвигаются вместе
+        if not {'main.rides', 'main.movement'} <= new_checkpoints.keys():
+            new_checkpoints.pop('main.rides', None)
+            new_checkpoints.pop('main.movement', None)
+
+        # Получаем информацию с FTP сервера
+        ftp_data = {}
+        if ftp_future:
+            ftp_data, manifest = ftp_future.result()
+            new_checkpoints.update({f'ftp:{key}': value for key, value in manifest.items()})
 
-                for key, value in info_dict.items():
-                    if key != 'waybill':
-                        info_dict[key] = value[2]
-                    else:
-                        temp = value[1]
-                        temp_dict = {}
-                        for par in temp:
-                            temp_dict[par[0]] = par[1]
+    for key, value in ftp_data.items():
+        #  Вносим в ДатаФрейм для payments данные, скачанные с FTP
+        if key == 'payments' and value != []:
+            ftp_data_processed["payments"] = parse_payments(value)
 
-                info_dict = dict(info_dict, **temp_dict)
-                del info_dict['waybill']
-                ftp_data_processed["waybills"].append(info_dict)
+        # "Парсим" данные XML-файлов с FTP
+        elif key == 'waybills' and value != []:
+            ftp_data_processed["waybills"] = parse_waybills(value)
 
     print('Данные успешно импортированы и сохранены')
     print('____________________________________________________________________________________________________\n')
 
-    # Удаляем содержимое файла с незавершенными поездками
-    global norm_path
-    os.chdir(norm_path)
-    try:
-        os.remove("log/log_movement_unfinished.txt")
-    except FileNotFoundError:
-        pass
+    # Объединяем словарь с данными, извлеченными из БД, со словарем данных FTP-сервера;
+    # новые контрольные точки сохраняются на этапе загрузки в тех же транзакциях, что и данные
+    data = dict(ftp_data_processed, checkpoints=new_checkpoints, **tables_dict)
+
+    # Пачка сохраняется в архив до загрузки, чтобы ее можно было загрузить повторно без обращения к источникам
+    if LANDING_DIR:
+        try:
+            write_batch(data)
+        except Exception as error:
+            print("Ошибка сохранения пачки в архив", error)
 
-    # Объединяем словарь с данными, извлеченными из БД, со словарем данных FTP-сервера
-    return dict(ftp_data_processed, **tables_dict)
\ No newline at end of file
+    return data
@@ -0,0 +1,73 @@
+import datetime
+import json
+import os
+import pandas as pd
+from config import get_config
+from logger import count, logger
+
+CONFIG = get_config()
+
+# Папка для сырых данных: каждая извлеченная пачка сохраняется в Parquet (пустое значение отключает сохранение)
+LANDING_DIR = CONFIG.get('LANDING_DIR', 'landing')
+LANDING_COMPRESSION = CONFIG.get('LANDING_COMPRESSION', 'zstd')
+
+# Ключи данных extract_data, которые сохраняются в пачке
+LANDING_SOURCES = ['main.car_pool', 'main.rides', 'main.movement', 'main.drivers', 'payments', 'waybills']
+
+
+def manifest_path() -> str:
+    return os.path.join(LANDING_DIR, 'manifest.jsonl')
+
+
+@logger
+def write_batch(data: dict) -> dict:
+    """Сохранение извлеченной пачки в Parquet с разбиением по дате и запись в манифест"""
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    batch_id = created_at.strftime('%Y%m%dT%H%M%S%f')
+    entry = {'batch_id': batch_id, 'created_at': created_at.isoformat(), 'date': str(created_at.date()),
+             'files': {}, 'checkpoints': data.get('checkpoints', {})}
+
+    for source in LANDING_SOURCES:
+        frame = data.get(source)
+        if not isinstance(frame, pd.DataFrame) or frame.empty:
+            continue
+
+        path = os.path.join(LANDING_DIR, source, f'dt={entry["date"]}', f'{batch_id}.parquet')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Файл пишется под временным именем, чтобы в архиве не оставались недописанные файлы
+        frame.to_parquet(path + '.tmp', compression=LANDING_COMPRESSION, index=False)
+        os.replace(path + '.tmp', path)
+
+        entry['files'][source] = {'path': os.path.relpath(path, LANDING_DIR), 'rows': len(frame)}
+        count(rows_in=len(frame), rows_out=len(frame), bytes=os.path.getsize(path))
+
+    # В манифест пачка попадает только после записи всех ее файлов; пустые пачки не сохраняются
+    if not entry['files']:
+        return entry
+    with open(manifest_path(), 'a') as manifest:
+        manifest.write(json.dumps(entry, default=str) + '\n')
+    return entry
+
+
+def read_manifest(date_from: datetime.date = None, date_to: datetime.date = None) -> list:
+    """Пачки из манифеста за период (включительно), в порядке извлечения"""
+    try:
+        with open(manifest_path()) as manifest:
+            entries = [json.loads(line) for line in manifest if line.strip()]
+    except FileNotFoundError:
+        return []
+
+    return [entry for entry in entries
+            if (date_from is None or str(date_from) <= entry['date'])
+            and (date_to is None or entry['date'] <= str(date_to))]
+
+
+def read_batch(entry: dict) -> dict:
+    """Чтение пачки из Parquet в тот же словарь, что возвращает extract_data (без контрольных точек)"""
+    data = {source: [] for source in LANDING_SOURCES}
+    for source, file in entry['files'].items():
+        # Колоночное чтение с отображением файла в память
+        data[source] = pd.read_parquet(os.path.join(LANDING_DIR, file['path']), memory_map=True)
+    # Контрольные точки при повторной загрузке не сохраняются - они относятся к источникам, а не к архиву
+    data['checkpoints'] = {}
+    return data
@@ -1,14 +1,182 @@
+import contextvars
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from functools import wraps
+from config import get_config
+
+CONFIG = get_config()
+
+# Файлы с метриками: журнал этапов в формате JSON lines и textfile для Prometheus (node_exporter)
+METRICS_LOG = CONFIG.get('METRICS_LOG', 'metrics.jsonl')
+METRICS_PROM = CONFIG.get('METRICS_PROM', 'etl.prom')
+
+# Идентификатор запуска процесса, по нему группируются строки журнала
+RUN_ID = uuid.uuid4().hex
+
+COUNTERS = ['rows_in', 'rows_out', 'round_trips', 'bytes']
+
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+_write_lock = threading.Lock()
+_latest = {}
+# Выполняющиеся этапы: пик памяти между замерами учитывается в каждом из них
+_active = set()
+_memory_lock = threading.Lock()
+
+
+def read_peak_rss() -> float:
+    """Пиковый RSS процесса (МБ) с последнего сброса (VmHWM); без /proc - за все время процесса (ru_maxrss)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> None:
+    """Сброс пикового RSS процесса до текущего (Linux 4.0+)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def sample_memory(started=None, finished=None) -> None:
+    """Пик памяти с прошлого замера записывается во все выполняющиеся этапы, затем сбрасывается.
+    Замер выполняется при начале и окончании каждого этапа, поэтому пик этапа - максимум RSS за время его работы"""
+    with _memory_lock:
+        peak = read_peak_rss()
+        for current in _active:
+            current.peak_rss = max(current.peak_rss, peak)
+        _active.discard(finished)
+        if started:
+            _active.add(started)
+        reset_peak_rss()
+
+
+class Stage:
+    """Метрики одного этапа: время, строки на входе/выходе, обращения к БД, скачанные байты, пиковая память"""
+
+    def __init__(self, name, parent=None, label=None):
+        self.name = name
+        self.parent = parent
+        self.label = label
+        self.peak_rss = 0.0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+
+    def add(self, **counters) -> None:
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+
+    def finish(self) -> dict:
+        seconds = time.perf_counter() - self.started
+        sample_memory(finished=self)
+        # Счетчики вложенного этапа входят и в родительский
+        if self.parent:
+            self.parent.add(**self.counters)
+
+        record = dict(run_id=RUN_ID, stage=self.name, source=self.label,
+                      parent=self.parent.name if self.parent else None,
+                      started_at=self.started_at.isoformat(), seconds=round(seconds, 6), **self.counters,
+                      rows_per_s=round(self.counters['rows_out'] / seconds, 1) if seconds else None,
+                      # Пиковое потребление памяти процессом за время этапа
+                      peak_rss_mb=round(self.peak_rss, 1))
+        write_metrics(record)
+        return record
 
-# Вывод log-инфорамции в консоль
-def logger(fn):
-    from datetime import datetime, timezone
+
+def count(**counters) -> None:
+    """Увеличение счетчиков текущего этапа (вне этапов вызов ничего не делает)"""
+    stage = _current_stage.get()
+    if stage:
+        stage.add(**counters)
+
+
+def set_label(value) -> None:
+    """Метка текущего этапа (таблица или источник), чтобы одновременные этапы с одним именем различались в метриках"""
+    stage = _current_stage.get()
+    if stage:
+        stage.label = value
+
+
+@contextmanager
+def stage(name, label=None):
+    """Замер этапа, который не оформлен отдельной функцией"""
+    current = Stage(name, _current_stage.get(), label)
+    sample_memory(started=current)
+    token = _current_stage.set(current)
+    try:
+        yield current
+    finally:
+        _current_stage.reset(token)
+        current.finish()
+
+
+def write_metrics(record: dict) -> None:
+    """Запись метрик этапа в журнал и обновление textfile для Prometheus (ошибка записи не прерывает этап)"""
+    try:
+        with _write_lock:
+            with open(METRICS_LOG, 'a') as metrics_log:
+                metrics_log.write(json.dumps(record) + '\n')
+
+            # textfile пишет только основной процесс: процессы пула (backfill) заменили бы его своими этапами
+            if multiprocessing.parent_process() is None:
+                write_prom(record)
+    except OSError as error:
+        print("Ошибка записи метрик", error)
+
+
+def write_prom(record: dict) -> None:
+    """Обновление textfile для Prometheus последними метриками каждого этапа"""
+    _latest[record['stage'], record['source']] = record
+    lines = []
+    for metric in ['seconds', *COUNTERS, 'peak_rss_mb']:
+        lines.append(f'# TYPE etl_stage_{metric} gauge')
+        lines.extend(f'etl_stage_{metric}{{stage="{name}"' + (f',source="{source}"' if source else '') +
+                     f'}} {values[metric]}' for (name, source), values in _latest.items())
+
+    # Файл заменяется атомарно, чтобы node_exporter не прочитал его наполовину записанным;
+    # временное имя уникально для процесса
+    tmp_path = f'{METRICS_PROM}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as prom_file:
+        prom_file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, METRICS_PROM)
+
+
+# Вывод log-инфорамции в консоль (без замера этапа - для коротких вспомогательных функций)
+def log(fn):
 
     @wraps(fn)
     def inner(*args, **kwargs):
         called_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
         print(f"» {fn.__doc__!r}. Logged at {called_at}")
         to_execute = fn(*args, **kwargs)
-        print(f"        Выполнено. Logged at {called_at}")
+        print(f"        Выполнено. Logged at {datetime.now(timezone.utc)} "
+              f"({time.perf_counter() - started:.2f} с)")
         return to_execute
-    return inner
\ No newline at end of file
+    return inner
+
+
+# Вывод log-инфорамции в консоль и замер этапа
+def logger(fn):
+
+    @wraps(fn)
+    def measured(*args, **kwargs):
+        with stage(fn.__name__):
+            return fn(*args, **kwargs)
+    return log(measured)
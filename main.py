@@ -1,17 +1,153 @@
+import argparse
+import datetime
+import fcntl
+import os
+import tempfile
 import time
+import traceback
+from contextlib import contextmanager
+from backfill import BACKFILL_WORKERS, run_backfill
+from config import get_config
 from extract import extract_data
+from landing import read_batch, read_manifest
+from pipeline import run_pipeline
 from report import make_reports
+from session import close_pools
 from transform_and_load import transform_and_load_data
 
+CONFIG = get_config()
+
+# Интервалы запуска этапов в режиме планировщика (с): данные БД, файлы FTP, отчеты
+SCHEDULE = {
+    'db': int(CONFIG.get('SCHEDULE_DB_INTERVAL', 60)),
+    'ftp': int(CONFIG.get('SCHEDULE_FTP_INTERVAL', 900)),
+    'reports': int(CONFIG.get('SCHEDULE_REPORTS_INTERVAL', 3600)),
+}
+
+# Файл блокировки, защищающий от одновременной работы нескольких экземпляров (планировщик, cron)
+LOCK_FILE = CONFIG.get('LOCK_FILE', os.path.join(tempfile.gettempdir(), 'etl_model.lock'))
+
+# Режим ETL-процесса: 'batch' - извлечение, затем загрузка; 'stream' - конвейер с одновременной загрузкой пакетов
+# (только в режиме 'stream' потребление памяти не зависит от размера извлекаемых таблиц)
+PIPELINE_MODE = CONFIG.get('PIPELINE_MODE', 'batch')
+
+
+def run_etl(db: bool = True, ftp: bool = True) -> None:
+    """ETL-процесс в выбранном режиме (db и ftp - какие источники опрашивать)"""
+    if PIPELINE_MODE == 'stream':
+        run_pipeline(db=db, ftp=ftp)
+    else:
+        transform_and_load_data(extract_data(db=db, ftp=ftp))
+
+
+STAGES = {
+    'db': lambda: run_etl(db=True, ftp=False),
+    'ftp': lambda: run_etl(db=False, ftp=True),
+    'reports': make_reports,
+}
+
+
+@contextmanager
+def run_lock():
+    """Захват блокировки без ожидания: False, если ее держит другой запуск"""
+    with open(LOCK_FILE, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_stage(name, stage) -> bool:
+    """Запуск этапа: ошибка одного этапа не останавливает остальные"""
+    with run_lock() as locked:
+        if not locked:
+            print(f'Этап {name} пропущен: предыдущий запуск еще не завершен')
+            return False
+
+        try:
+            stage()
+            return True
+        except Exception:
+            print(f'Этап {name} завершился с ошибкой')
+            traceback.print_exc()
+            return False
+
+
+def run_once() -> bool:
+    """Один полный цикл: ETL-процесс по всем источникам и создание отчетов"""
+    etl_ok = run_stage('etl', run_etl)
+    reports_ok = run_stage('reports', make_reports)
+    return etl_ok and reports_ok
+
+
+def replay(date_from: datetime.date, date_to: datetime.date) -> bool:
+    """Повторная загрузка в DWH и построение отчетов из архива за период, без обращения к источникам"""
+    entries = read_manifest(date_from, date_to)
+    print(f'Повторная загрузка из архива: {len(entries)} пачек за {date_from} - {date_to}')
+
+    # Пачки загружаются по одной в порядке извлечения, чтобы состояние dim_ таблиц совпало с исходным;
+    # контрольные точки источников при этом не меняются
+    # Незавершенные поездки переносятся между пачками в памяти, общий буфер etl_pending_rides не используется
+    def stage():
+        replay_buffer = {}
+        for entry in entries:
+            print(f"Пачка {entry['batch_id']}: " +
+                  ', '.join(f"{source} - {file['rows']}" for source, file in entry['files'].items()))
+            transform_and_load_data(read_batch(entry), replay_buffer)
+
+    return run_stage('replay', stage) and run_stage('reports', make_reports)
+
+
+def backfill(workers: int) -> bool:
+    """Первичная загрузка истории в пуле процессов, затем построение отчетов"""
+    return run_stage('backfill', lambda: run_backfill(workers)) and run_stage('reports', make_reports)
+
+
+def run_scheduler() -> None:
+    """Запуск этапов по расписанию, каждый со своим интервалом"""
+    next_run = {name: time.monotonic() for name in STAGES}
+    while True:
+        for name, stage in STAGES.items():
+            if time.monotonic() >= next_run[name]:
+                run_stage(name, stage)
+                next_run[name] = time.monotonic() + SCHEDULE[name]
+
+        time.sleep(max(0.0, min(next_run.values()) - time.monotonic()))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ETL-процесс и построение отчетов')
+    parser.add_argument('--once', action='store_true', help='выполнить один цикл и завершиться (для cron/systemd)')
+    commands = parser.add_subparsers(dest='command')
+    replay_parser = commands.add_parser('replay', help='загрузить в DWH пачки из архива без обращения к источникам')
+    replay_parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat, required=True,
+                               help='дата первой пачки (ГГГГ-ММ-ДД)')
+    replay_parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat, required=True,
+                               help='дата последней пачки включительно (ГГГГ-ММ-ДД)')
+    backfill_parser = commands.add_parser('backfill', help='загрузить историю частями по диапазонам ride_id '
+                                                           'в нескольких процессах')
+    backfill_parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='число процессов')
+    args = parser.parse_args()
+
     try:
-        while True:
-            # ETL-процесс
-            transform_and_load_data(extract_data())
-            # Создание отчетов
-            make_reports()
-            time.sleep(86400)
+        if args.command == 'replay':
+            raise SystemExit(0 if replay(args.date_from, args.date_to) else 1)
+        if args.command == 'backfill':
+            raise SystemExit(0 if backfill(args.workers) else 1)
+        if args.once:
+            raise SystemExit(0 if run_once() else 1)
+        run_scheduler()
 
     # Принудительное завершение работы
     except KeyboardInterrupt:
-        print('Процесс остановлен пользователем')
\ No newline at end of file
+        print('Процесс остановлен пользователем')
+
+    # Соединения с БД переиспользуются между запусками этапов и закрываются при выходе
+    finally:
+        close_pools()
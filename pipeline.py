@@ -0,0 +1,226 @@
+import contextvars
+import datetime
+import queue
+import threading
+import pandas as pd
+from checkpoint import incoming_ride_ids, merge_pending_rides, write_checkpoints, write_pending_rides
+from config import get_config
+from extract import DB_TABLE_NAMES, FTP_TABLE_NAMES, advance_checkpoint, db_session, get_ftps, id_watermark
+from extract import iter_table, parse_payments, parse_waybills, read_state
+from landing import LANDING_DIR, write_batch
+from logger import logger
+from transform_and_load import update_dim_cars, update_dim_clients, update_dim_drivers, update_dim_drivers_start_dt
+from transform_and_load import update_dim_end_dt, update_fact_payments, update_fact_rides, update_fact_waybills
+
+CONFIG = get_config()
+
+# Максимальное число пакетов в очереди каждой таблицы: при заполнении очереди извлечение ждет загрузку
+PIPELINE_QUEUE_SIZE = int(CONFIG.get('PIPELINE_QUEUE_SIZE', 4))
+
+# Признак конца потока пакетов
+DONE = object()
+
+
+class Stopped(Exception):
+    """Конвейер остановлен из-за ошибки на другом этапе"""
+
+
+def put(out: queue.Queue, item, stop: threading.Event) -> None:
+    """Помещение пакета в очередь с ожиданием места; ожидание прерывается остановкой конвейера"""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+    raise Stopped()
+
+
+def consume(source: queue.Queue):
+    """Пакеты из очереди до признака конца; ошибка этапа извлечения пробрасывается загрузке"""
+    while True:
+        item = source.get()
+        if item is DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def produce(out: queue.Queue, stop: threading.Event, batches) -> None:
+    """Передача пакетов в очередь; в конце - признак конца или ошибка"""
+    try:
+        for batch in batches():
+            put(out, batch, stop)
+        item = DONE
+    except Stopped:
+        return
+    except Exception as error:
+        item = error
+
+    # Признак конца тоже ждет места в очереди: после остановки конвейера его уже никто не прочитает
+    try:
+        put(out, item, stop)
+    except Stopped:
+        pass
+
+
+def extract_table(table_name: str, checkpoint: dict, pending: list):
+    """Потоковое извлечение таблицы БД пакетами по отдельному соединению"""
+    def batches():
+        with db_session() as (cursor, connection):
+            yield from iter_table(table_name, connection, checkpoint, pending)
+    return batches
+
+
+def transform_files(key: str, files: list):
+    """Разбор скачанных файлов payments или waybills в ДатаФрейм (этап преобразования)"""
+    def batches():
+        if files:
+            yield parse_waybills(files) if key == 'waybills' else parse_payments(files)
+    return batches
+
+
+def extract_ftp(queues: dict, stop: threading.Event, manifest: dict, results: dict) -> None:
+    """Скачивание новых файлов с FTP; каждая папка разбирается в своем потоке преобразования"""
+    try:
+        ftp_data, results['manifest'] = get_ftps(manifest)
+    except Exception as error:
+        for key in FTP_TABLE_NAMES:
+            try:
+                put(queues[key], error, stop)
+            except Stopped:
+                return
+        return
+
+    transforms = [start(produce, queues[key], stop, transform_files(key, ftp_data[key])) for key in FTP_TABLE_NAMES]
+    for thread in transforms:
+        thread.join()
+
+
+def start(target, *args) -> threading.Thread:
+    # Поток выполняется в копии контекста, чтобы счетчики попадали в метрики этапа
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target, *args), daemon=True)
+    thread.start()
+    return thread
+
+
+@logger
+def run_pipeline(db: bool = True, ftp: bool = True) -> None:
+    """Конвейер: извлечение, преобразование и загрузка пакетов одновременно (db и ftp - какие источники опрашивать)"""
+    print(f'Обновление данных (конвейер) {datetime.datetime.now()}')
+    checkpoints, pending = read_state()
+
+    stop = threading.Event()
+    queues = {name: queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for name in DB_TABLE_NAMES + FTP_TABLE_NAMES}
+    threads = []
+
+    # Каждая таблица БД извлекается своим потоком по своему соединению
+    for name in DB_TABLE_NAMES:
+        if db:
+            threads.append(start(produce, queues[name], stop,
+                                 extract_table(name, checkpoints[name], pending if id_watermark(name) else ())))
+        else:
+            queues[name].put(DONE)
+
+    # Файлы FTP скачиваются одним потоком, затем payments и waybills разбираются параллельно
+    ftp_results = {}
+    if ftp:
+        threads.append(start(extract_ftp, queues, stop, {key: checkpoints[f'ftp:{key}'] for key in FTP_TABLE_NAMES},
+                             ftp_results))
+    else:
+        for key in FTP_TABLE_NAMES:
+            queues[key].put(DONE)
+
+    try:
+        load_pipeline(queues, checkpoints, ftp_results)
+    finally:
+        # При ошибке загрузки потоки извлечения прекращают ждать места в очередях
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    print('Данные успешно импортированы и сохранены')
+    print('____________________________________________________________________________________________________\n')
+
+
+def archive(data: dict) -> None:
+    """Сохранение загружаемых пакетов в архив Parquet, как в пакетном режиме (для повторной загрузки replay)"""
+    if LANDING_DIR:
+        try:
+            write_batch(data)
+        except Exception as error:
+            print("Ошибка сохранения пачки в архив", error)
+
+
+def load_pipeline(queues: dict, checkpoints: dict, ftp_results: dict) -> None:
+    """Загрузка пакетов в DWH в порядке зависимостей: измерения, путевые листы, транзакции, поездки"""
+    with db_session(dwh=True) as (cursor, connection):
+        # Измерения: пакеты упорядочены по update_dt, контрольная точка сохраняется после всех пакетов таблицы
+        dim_keys = {}
+        for table_name, update_dim in [('main.drivers', update_dim_drivers), ('main.car_pool', update_dim_cars)]:
+            checkpoint = checkpoints[table_name]
+            dim_keys[table_name] = []
+            for batch in consume(queues[table_name]):
+                archive({table_name: batch})
+                update_dim(cursor, batch)
+                # Ключ измерения - первая колонка (для водителей - табельный номер из номера удостоверения)
+                keys = batch.iloc[:, 0].str[-6:] if table_name == 'main.drivers' else batch.iloc[:, 0]
+                dim_keys[table_name] += list(keys)
+                checkpoint = advance_checkpoint(table_name, checkpoint, batch)
+            write_checkpoints(cursor, {table_name: checkpoint})
+            connection.commit()
+
+        # Путевые листы загружаются до поездок: по ним определяются водители
+        for batch in consume(queues['waybills']):
+            archive({'waybills': batch})
+            update_fact_waybills(cursor, batch)
+            update_dim_drivers_start_dt(cursor, batch)
+        for batch in consume(queues['payments']):
+            archive({'payments': batch})
+            update_fact_payments(cursor, batch)
+        if 'manifest' in ftp_results:
+            write_checkpoints(cursor, {f'ftp:{key}': value for key, value in ftp_results['manifest'].items()})
+        connection.commit()
+
+        # Поездки: пакет rides загружается вместе с пакетами movement, одной транзакцией.
+        # Поездки, события которых еще не получены, и события без строки поездки остаются в буфере
+        # до следующих пакетов, поэтому контрольные точки можно сдвигать после каждой транзакции
+        rides_checkpoint, movement_checkpoint = checkpoints['main.rides'], checkpoints['main.movement']
+        rides_stream, movement_stream = consume(queues['main.rides']), consume(queues['main.movement'])
+        while True:
+            rides = next(rides_stream, None)
+
+            # События читаются, пока не дойдут до поездок следующего пакета rides
+            # (после окончания rides - по одному пакету событий)
+            movement = []
+            for batch in movement_stream:
+                movement.append(batch)
+                if rides is None or batch['ride'].max() > rides['ride_id'].max():
+                    break
+            if rides is None and not movement:
+                break
+            rides = rides if rides is not None else pd.DataFrame()
+            movement = pd.concat(movement, ignore_index=True) if movement else pd.DataFrame()
+            # Пакеты rides и movement одной транзакции сохраняются в архив одной пачкой
+            archive({'main.rides': rides, 'main.movement': movement})
+
+            update_dim_clients(cursor, rides)
+            pending_rides, pending_movement = merge_pending_rides(cursor, rides, movement)
+            loaded, unfinished = update_fact_rides(cursor, pending_rides, pending_movement, pd.DataFrame())
+            update_dim_end_dt(cursor,
+                              clients=list(rides['client_phone'] if not rides.empty else []) +
+                              list(loaded['client_phone']),
+                              drivers=list(loaded['driver_pers_num']),
+                              cars=list(loaded['car_plate_num']))
+            write_pending_rides(cursor, pending_rides, pending_movement, list(loaded['ride_id']), unfinished,
+                                incoming_ride_ids(rides, movement))
+
+            rides_checkpoint = advance_checkpoint('main.rides', rides_checkpoint, rides)
+            movement_checkpoint = advance_checkpoint('main.movement', movement_checkpoint, movement)
+            write_checkpoints(cursor, {'main.rides': rides_checkpoint, 'main.movement': movement_checkpoint})
+            connection.commit()
+
+        # end_dt для водителей и машин из пакетов измерений
+        update_dim_end_dt(cursor, clients=[], drivers=dim_keys['main.drivers'], cars=dim_keys['main.car_pool'])
+        connection.commit()
@@ -1,145 +1,106 @@
-import datetime
 import psycopg2
-from psycopg2 import extras
-from config import get_config
-from extract import connect_db
-from extract import disconnect_db
-import pandas as pd
+from checkpoint import write_checkpoints
+from extract import db_session
+from logger import count
 from logger import logger
+from session import execute_prepared
 
-CONFIG = get_config()
-
-def get_table(cursor, query:str) -> pd.DataFrame:
-    """Получение таблицы по запросу"""
-    cursor.execute(query)
-    column_names = [desc[0] for desc in cursor.description]
-    table_records = cursor.fetchall()
-    table_list = []
-    table_records = [list(row) for row in table_records]
-    for row in table_records:
-        for i in range(len(row)):
-            row[i] = str(row[i])
-        row = dict(zip(column_names, row))
-        table_list.append(row)
-    return pd.DataFrame(table_list)
-
-
-def load_values(conn, df, table) -> None:
-    tuples = [tuple(x) for x in df.to_numpy()]
-
-    cols = ','.join(list(df.columns))
-
-    query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
-    cursor = conn.cursor()
-
-    try:
-        extras.execute_values(cursor, query, tuples)
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Error: %s" % error)
-        conn.rollback()
-        cursor.close()
-        return 1
-    cursor.close()
 
 @logger
 def make_report_1(cursor, connection) -> None:
     """Построение первого отчёта"""
 
-    # Получение таблицы с персональными данными водителя
-    postgreSQL_select_Query = "SELECT personnel_num, last_name, first_name, middle_name, card_num FROM dim_drivers"
-    dim_drivers = get_table(cursor, postgreSQL_select_Query)
-
-    # Получение таблицы с зарплатой водителя за день
-    postgreSQL_select_Query = "SELECT driver_pers_num AS personnel_num, " \
-                              "(price_amt - (price_amt * 0.2) - (47.26 * 7 * distance_val / 100) - " \
-                              "(5 * distance_val)) AS amount, DATE(ride_end_dt) AS report_dt " \
-                              "FROM fact_rides"
+    # Зарплата водителя за день считается в БД и только за дни после последней даты отчёта
+    # (если таблица пустая - за все дни) и до сегодняшнего дня, поэтому время построения
+    # зависит от числа новых поездок, а не от всей истории fact_rides
+    postgreSQL_insert_Query = """INSERT INTO dwh_voronezh.rep_drivers_payments(
+                                     personnel_num, last_name, first_name, middle_name, card_num, report_dt, amount)
+                                 SELECT d.personnel_num, d.last_name, d.first_name, d.middle_name, d.card_num,
+                                        r.report_dt, r.amount
+                                 FROM (SELECT driver_pers_num, DATE(ride_end_dt) AS report_dt,
+                                              SUM(price_amt - (price_amt * 0.2) - (47.26 * 7 * distance_val / 100) -
+                                                  (5 * distance_val)) AS amount
+                                       FROM fact_rides
+                                       WHERE ride_end_dt >= (SELECT COALESCE(MAX(report_dt), DATE '1970-01-01') + 1
+                                                             FROM rep_drivers_payments)
+                                         AND ride_end_dt < CURRENT_DATE
+                                       GROUP BY driver_pers_num, DATE(ride_end_dt)) AS r
+                                 JOIN dim_drivers AS d ON d.personnel_num = r.driver_pers_num"""
 
-    drivers_amount = get_table(cursor, postgreSQL_select_Query)
-    drivers_amount['amount'] = drivers_amount['amount'].astype('float')
-    drivers_amount['report_dt'] = pd.to_datetime(drivers_amount['report_dt'])
-    drivers_amount = drivers_amount.groupby(['personnel_num', 'report_dt'], as_index=False).sum()
-    res_df = pd.merge(dim_drivers, drivers_amount, on='personnel_num', how='inner')
-    now = str(datetime.datetime.now().date())
-
-    # Подключаемся к БД, для взятия последней даты построения отчёта
-    postgreSQL_select_Query = "SELECT MAX(report_dt) FROM rep_drivers_payments"
-
-    # Если таблица пустая, то загружаем все строки. Иначе последняя дата < x < сегодня
-    last_report_date = get_table(cursor, postgreSQL_select_Query).values[0][0]
-    last_report_date = last_report_date if last_report_date != 'None' else '1970-01-01'
+    try:
+        execute_prepared(cursor, 'make_report_1', postgreSQL_insert_Query)
+        count(rows_out=cursor.rowcount)
+        connection.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Error: %s" % error)
+        connection.rollback()
 
-    # Фильтруем df и загружаем в отчёт в БД
-    res_df = res_df[(res_df['report_dt'] > last_report_date) & (res_df['report_dt'] < now)]
-    load_values(connection, res_df, 'dwh_voronezh.rep_drivers_payments')
 
 @logger
 def make_report_2(cursor, connection) -> None:
     """Построение второго отчёта"""
 
-    postgreSQL_select_Query = "SELECT * FROM " \
-                              "(SELECT ride_end_dt, driver_pers_num AS personnel_num, ride_id AS ride, " \
-                              "distance_val /" \
-                              " (DATE_PART('hour', ride_end_dt - ride_start_dt) + " \
-                              "DATE_PART('minute', ride_end_dt - ride_start_dt) / 60 + " \
-                              "DATE_PART('second', ride_end_dt - ride_start_dt) / 3600)" \
-                              " AS speed FROM fact_rides) AS Subquery " \
-                              "WHERE speed > 85"
-
-    current_drive = get_table(cursor, postgreSQL_select_Query)
-    current_drive['violations_cnt'] = 1
-
-    # Получаем количество нарушений, сделанных водителем ранее
-    postgreSQL_select_Query = "SELECT personnel_num, MAX(violations_cnt) AS violations_cnt" \
-                              " FROM rep_drivers_violations " \
-                              "GROUP BY personnel_num"
-    previous_drives = get_table(cursor, postgreSQL_select_Query)
-
-    # Получаем список поездок, которые уже есть в БД, чтобы их не учитывать в отчёте
-    postgreSQL_select_Query = "SELECT ride FROM rep_drivers_violations"
-    report_drives = get_table(cursor, postgreSQL_select_Query)
-    report_drives = list(report_drives['ride'].values)
-    current_drive = current_drive.loc[~current_drive['ride'].isin(report_drives)]
-
-    # Присоединяем к текущему отчёту информацию о количестве предыдущих нарушений
+    # Просматриваются только поездки после сохранённой границы ride_id; в отчёт попадают те из них,
+    # которых в нём ещё нет (anti-join по ride).
+    # Скорость считается по полной длительности поездки; отменённые поездки (без ride_start_dt)
+    # и поездки нулевой длительности исключаются, чтобы не делить на ноль.
+    # Количество нарушений - накопленная сумма по водителю (оконная функция по времени окончания поездки),
+    # продолжающая максимальное значение, уже записанное в отчёт; как и раньше, первое нарушение водителя
+    # записывается с violations_cnt = 0
+    postgreSQL_insert_Query = """INSERT INTO dwh_voronezh.rep_drivers_violations(
+                                     personnel_num, ride, speed, violations_cnt)
+                                 SELECT v.personnel_num, v.ride, v.speed,
+                                        COALESCE(prev.violations_cnt, -1) +
+                                        ROW_NUMBER() OVER (PARTITION BY v.personnel_num
+                                                           ORDER BY v.ride_end_dt, v.ride) AS violations_cnt
+                                 FROM (SELECT driver_pers_num AS personnel_num, ride_id AS ride, ride_end_dt,
+                                              distance_val /
+                                              (EXTRACT(EPOCH FROM ride_end_dt - ride_start_dt) / 3600) AS speed
+                                       FROM fact_rides AS f
+                                       WHERE ride_id > %s
+                                         AND ride_start_dt IS NOT NULL
+                                         AND ride_end_dt > ride_start_dt
+                                         AND NOT EXISTS (SELECT 1 FROM rep_drivers_violations AS r
+                                                         WHERE r.ride = f.ride_id)) AS v
+                                 LEFT JOIN (SELECT personnel_num, MAX(violations_cnt) AS violations_cnt
+                                            FROM rep_drivers_violations
+                                            GROUP BY personnel_num) AS prev
+                                 ON prev.personnel_num = v.personnel_num
+                                 WHERE v.speed > 85"""
+
+    # Новая граница - максимальный ride_id в fact_rides, но не дальше самой ранней незавершенной поездки:
+    # поездки из буфера попадают в fact_rides позже поездок с большим ride_id
+    watermark_Query = """SELECT LEAST(COALESCE(MAX(ride_id), 0),
+                                        COALESCE((SELECT MIN(ride_id) - 1 FROM dwh_voronezh.etl_pending_rides),
+                                                 MAX(ride_id), 0))
+                           FROM fact_rides"""
 
-    # Обрабатываем исключение если таблица пустая
     try:
-        res_df = pd.merge(current_drive, previous_drives, on='personnel_num', how='left')
-    except KeyError:
-        res_df = current_drive
-        res_df.rename(columns={'violations_cnt': 'violations_cnt_x'}, inplace=True)
-        res_df['violations_cnt_y'] = -1
-
-    # Нужно учесть, что в день водитель мог совершить несколько нарушений,
-    # значит нужно считать накопленную сумму
-    res_df['violations_cnt_y'] = res_df['violations_cnt_y'].fillna(-1).astype('int')
-    res_df = res_df.sort_values('ride_end_dt')
-
-    # Считаем накопленную сумму, сгруппированную по каждому водителю
-    res_df["violations_cnt_x"] = res_df[['personnel_num', "violations_cnt_x"]].groupby('personnel_num').cumsum()
-    res_df.sort_index(inplace=True)
-    '''Объяснение: столбец violations_count_x считает накопленную сумму внутри дня, 
-    а violations_count_y хранит предыдущие нарушения -> при их сложении получится актуальное кол-во нарушений'''
-    res_df['violations_cnt'] = res_df['violations_cnt_x'] + res_df['violations_cnt_y']
-
-    # Оставляем только нужные для исходного отчёта столбцы
-    res_df = res_df[['personnel_num', 'ride', 'speed', 'violations_cnt']]
+        cursor.execute("SELECT value FROM dwh_voronezh.etl_checkpoints WHERE source = 'report:violations'")
+        stored = cursor.fetchone()
+        watermark = int(stored[0]['ride_id']) if stored else 0
+
+        # Граница считается до построения отчёта: поездки, загруженные после этого, попадут в следующий отчёт
+        execute_prepared(cursor, 'report_2_watermark', watermark_Query)
+        new_watermark, = cursor.fetchone()
+
+        execute_prepared(cursor, 'make_report_2', postgreSQL_insert_Query, (watermark,))
+        count(rows_out=cursor.rowcount)
+        # Граница сохраняется в одной транзакции с отчётом
+        write_checkpoints(cursor, {'report:violations': {'ride_id': int(new_watermark)}})
+        connection.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Error: %s" % error)
+        connection.rollback()
 
-    # Загрузка отчёта
-    load_values(connection, res_df, 'dwh_voronezh.rep_drivers_violations')
 
 def make_reports():
-    # Подключение к нашей базе данных
-    cursor, connection = connect_db(configs=CONFIG, dwh=True)
-
-    # Создание первого отчёта
-    make_report_1(cursor, connection)
+    # Соединение с нашей базой данных берется из общего пула и возвращается в него по завершении
+    with db_session(dwh=True) as (cursor, connection):
+        # Создание первого отчёта
+        make_report_1(cursor, connection)
 
-    # Создание второго отчёта
-    make_report_2(cursor, connection)
+        # Создание второго отчёта
+        make_report_2(cursor, connection)
 
-    # Отключаемся от конечной базы данных
-    disconnect_db(connection, cursor)
     print('____________________________________________________________________________________________________\n')
\ No newline at end of file
@@ -0,0 +1,167 @@
+import queue
+import threading
+import time
+import psycopg2
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extensions import connection as base_connection, cursor as base_cursor
+from config import get_config
+from logger import count
+
+CONFIG = get_config()
+
+# Размер пула соединений с каждой БД (источник и DWH), число попыток подключения и базовая задержка между ними (с)
+DB_POOL_SIZE = int(CONFIG.get('DB_POOL_SIZE', 5))
+DB_RETRIES = int(CONFIG.get('DB_RETRIES', 3))
+DB_BACKOFF = float(CONFIG.get('DB_BACKOFF', 1.0))
+# Соединение, простоявшее в пуле дольше этого времени (с), перед выдачей проверяется запросом SELECT 1
+DB_HEALTHCHECK_INTERVAL = float(CONFIG.get('DB_HEALTHCHECK_INTERVAL', 30))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class CountingCursor(base_cursor):
+    """Курсор, учитывающий обращения к серверу в метриках текущего этапа"""
+
+    def execute(self, query, vars=None):
+        count(round_trips=1)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        count(round_trips=1)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count(round_trips=1)
+        return super().copy_expert(sql, file, size)
+
+    def copy_from(self, file, table, sep='\t', null='\\N', size=8192, columns=None):
+        count(round_trips=1)
+        return super().copy_from(file, table, sep, null, size, columns)
+
+
+class PooledConnection(base_connection):
+    """Соединение из пула: помнит свой пул и подготовленные на сервере запросы"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class DbPool:
+    """Ограниченный пул переиспользуемых соединений с одной БД"""
+
+    def __init__(self, params: dict, size: int = DB_POOL_SIZE, retries: int = DB_RETRIES,
+                 backoff: float = DB_BACKOFF):
+        self.params = params
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def healthy(self, connection) -> bool:
+        """Проверка соединения перед выдачей (давно не использованное проверяется запросом к серверу)"""
+        if connection.closed:
+            return False
+        if time.monotonic() - connection.last_used < DB_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def connect(self):
+        """Открытие нового соединения с повторными попытками и экспоненциальной задержкой"""
+        for attempt in range(1, self.retries + 1):
+            try:
+                connection = psycopg2.connect(connection_factory=PooledConnection, cursor_factory=CountingCursor,
+                                              **self.params)
+                connection.pool = self
+                return connection
+            except OperationalError as error:
+                if attempt == self.retries:
+                    raise
+                print(f'Ошибка подключения к PostgreSQL (попытка {attempt}): {error}')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def get(self):
+        """Получение соединения (новое открывается, только если в пуле нет исправных); ждет свободного места"""
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    connection = self.connections.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if self.healthy(connection):
+                    return connection
+                # Разорванное соединение отбрасывается, вместо него будет открыто новое
+                connection.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def put(self, connection) -> None:
+        """Возврат соединения: незавершенная транзакция откатывается, разорванное соединение закрывается"""
+        try:
+            if not connection.closed:
+                connection.rollback()
+                connection.last_used = time.monotonic()
+                self.connections.put(connection)
+        except (OperationalError, InterfaceError):
+            connection.close()
+        finally:
+            self.slots.release()
+
+    def close(self) -> None:
+        """Закрытие всех соединений пула"""
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def get_pool(params: dict) -> DbPool:
+    """Общий для всего процесса пул соединений с БД с заданными параметрами"""
+    key = tuple(sorted(params.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = DbPool(params)
+        return _pools[key]
+
+
+def close_pools() -> None:
+    """Закрытие всех пулов (при завершении процесса)"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def execute_prepared(cursor, name: str, query: str, params: tuple = ()) -> None:
+    """Выполнение запроса как подготовленного на сервере (PREPARE один раз на соединение, далее EXECUTE)"""
+    connection = cursor.connection
+    prepared = getattr(connection, 'prepared', None)
+    if prepared is None:
+        # Соединение не из пула - обычное выполнение
+        cursor.execute(query, params or None)
+        return
+
+    if name not in prepared:
+        # Параметры %s заменяются на позиционные $1, $2, ...
+        parts = query.split('%s')
+        cursor.execute(f"PREPARE {name} AS " + parts[0] +
+                       ''.join(f'${number}{part}' for number, part in enumerate(parts[1:], 1)))
+        prepared.add(name)
+
+    if params:
+        cursor.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
@@ -1,215 +1,378 @@
-import os
+import io
 import pandas as pd
-from tqdm import tqdm
+from checkpoint import incoming_ride_ids
+from checkpoint import merge_pending_rides
+from checkpoint import write_checkpoints
+from checkpoint import write_pending_rides
 from config import get_config
-from extract import connect_db
-from extract import disconnect_db
+from extract import db_session
+from extract import records_to_frame
+from logger import count
+from logger import logger
 from psycopg2 import Error
-from datetime import datetime
+from psycopg2 import extras
+from session import execute_prepared
 
 CONFIG = get_config()
 
+# Размер пакета вставки фактов (строк под одним savepoint) и число строк в одном INSERT
+FACT_BATCH_SIZE = int(CONFIG.get('FACT_BATCH_SIZE', 50000))
+FACT_PAGE_SIZE = int(CONFIG.get('FACT_PAGE_SIZE', 1000))
+
+
+def copy_to_staging(cursor, frame, table, columns) -> None:
+    """Загрузка ДатаФрейма во временную staging-таблицу через COPY"""
+    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(f"CREATE TEMP TABLE {table} ({', '.join(f'{name} {type_}' for name, type_ in columns)}) "
+                   f"ON COMMIT DROP")
+
+    # NULL передается как \N, чтобы не путать его с пустой строкой
+    buffer = io.StringIO()
+    frame[[name for name, _ in columns]].to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    count(rows_in=len(frame))
+
+
+def insert_facts(cursor, table, frame, columns) -> list:
+    """Пакетная вставка фактов (INSERT ... ON CONFLICT DO NOTHING), возвращает отклоненные строки"""
+    # NaN/NaT заменяются на None, чтобы в БД попадал NULL, а не 'NaN'
+    values = frame[columns].astype(object).where(frame[columns].notna(), None)
+    rows = list(values.itertuples(index=False, name=None))
+    query = f"INSERT INTO {table}({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING"
+    # Одиночные строки (после деления ошибочной части) вставляются подготовленным на сервере запросом
+    row_query = f"INSERT INTO {table}({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) " \
+                f"ON CONFLICT DO NOTHING"
+    rejected = []
+
+    def insert(chunk):
+        # Каждая часть вставляется под своим savepoint: ошибка откатывает только ее,
+        # затем часть делится пополам, пока не будут найдены ошибочные строки
+        cursor.execute("SAVEPOINT insert_facts")
+        try:
+            if len(chunk) == 1:
+                execute_prepared(cursor, f"insert_{table.split('.')[-1]}", row_query, chunk[0])
+            else:
+                extras.execute_values(cursor, query, chunk, page_size=FACT_PAGE_SIZE)
+            cursor.execute("RELEASE SAVEPOINT insert_facts")
+        except Error as error:
+            cursor.execute("ROLLBACK TO SAVEPOINT insert_facts")
+            cursor.execute("RELEASE SAVEPOINT insert_facts")
+            if len(chunk) == 1:
+                print(f"Ошибка sql-запроса ({table}): ", error)
+                rejected.append(chunk[0])
+            else:
+                insert(chunk[:len(chunk) // 2])
+                insert(chunk[len(chunk) // 2:])
+
+    for start in range(0, len(rows), FACT_BATCH_SIZE):
+        insert(rows[start:start + FACT_BATCH_SIZE])
 
+    count(rows_in=len(rows), rows_out=len(rows) - len(rejected))
+    return rejected
+
+
+@logger
 def update_dim_clients(cursor, table):
     """Добавление/обновление данных о клиентах"""
     if not table.empty:
-        for row in tqdm(table.iterrows()):
-            # Получаем дату последней поездки клиента
-            cursor.execute(
-                f"select max(ride_end_dt) from dwh_voronezh.fact_rides where client_phone_num = '{row[1].loc['client_phone']}'")
-            end = cursor.fetchall()[0][0]
-            end = end.date() if end else None
-
-            # Вносим изменения в таблицу при помощи SQL-запроса
-            cursor.execute(f'''INSERT INTO dwh_voronezh.dim_clients(phone_num, start_dt, card_num, deleted_flag, end_dt)
-                               VALUES('{row[1].loc['client_phone']}', '{row[1].loc['dt']}', '{row[1].loc['card_num'].replace(" ", "")}', '{'N'}', %s)
-                               ON CONFLICT (phone_num) DO UPDATE
-                               SET card_num={row[1].loc['card_num'].replace(" ", "")}, end_dt = %s''', (end, end))
+        clients = pd.DataFrame({'phone_num': table['client_phone'],
+                                'dt': table['dt'],
+                                'card_num': table['card_num'].str.replace(" ", "")})
+        copy_to_staging(cursor, clients, 'staging_clients',
+                        [('phone_num', 'text'), ('dt', 'timestamp'), ('card_num', 'text')])
+
+        # Один запрос на всю пачку: start_dt - первая поездка в пачке, card_num - из последней
+        # (end_dt пересчитывается после загрузки фактов в update_dim_end_dt)
+        cursor.execute('''INSERT INTO dwh_voronezh.dim_clients(phone_num, start_dt, card_num, deleted_flag, end_dt)
+                          SELECT phone_num, start_dt, card_num, 'N', NULL
+                          FROM (SELECT DISTINCT ON (phone_num) phone_num, card_num,
+                                       min(dt) OVER (PARTITION BY phone_num) AS start_dt
+                                FROM staging_clients
+                                ORDER BY phone_num, dt DESC) AS s
+                          ON CONFLICT (phone_num) DO UPDATE
+                          SET card_num = EXCLUDED.card_num''')
 
         print("dim_clients updated")
 
 
+@logger
 def update_dim_cars(cursor, car_pool) -> None:
     """Добавление/обновление данных о машинах"""
     if not car_pool.empty:
-        for car in tqdm(car_pool.iterrows()):
-
-            plate_num, car_model, revision_dt, register_dt, finished_flg, update_dt = car[1:][0]
-
-            # Проверяем, списана ли машина
-            if finished_flg == "Y":
-                end_dt = revision_dt
-            else:
-                # Получаем дату последней поездки на данной машине
-                cursor.execute(
-                    f"select max(work_end_dt) from dwh_voronezh.fact_waybills where car_plate_num = '{plate_num}'")
-                end_dt = cursor.fetchall()[0][0]
-                end_dt = end_dt.date() if end_dt else None
-
-            # Вносим изменения в таблицу при помощи SQL-запроса
-            cursor.execute('''INSERT INTO dwh_voronezh.dim_cars(
-                              plate_num, start_dt, model_name, revision_dt, deleted_flag, end_dt)
-                              VALUES(%s, %s, %s, %s, %s, %s)
-                              ON CONFLICT (plate_num) DO 
-                              UPDATE SET start_dt = %s, revision_dt = %s, deleted_flag = %s, end_dt = %s''',
-                              (plate_num, register_dt, car_model, revision_dt, finished_flg, end_dt,
-                              register_dt, revision_dt, finished_flg, end_dt))
+        cars = car_pool.iloc[:, :6].copy()
+        cars.columns = ['plate_num', 'model_name', 'revision_dt', 'register_dt', 'finished_flg', 'update_dt']
+        copy_to_staging(cursor, cars, 'staging_cars',
+                        [('plate_num', 'text'), ('model_name', 'text'), ('revision_dt', 'timestamp'),
+                         ('register_dt', 'timestamp'), ('finished_flg', 'text'), ('update_dt', 'timestamp')])
+
+        # Для списанной машины end_dt - дата списания, для остальных он пересчитывается
+        # после загрузки фактов в update_dim_end_dt
+        cursor.execute('''INSERT INTO dwh_voronezh.dim_cars(
+                          plate_num, start_dt, model_name, revision_dt, deleted_flag, end_dt)
+                          SELECT plate_num, register_dt, model_name, revision_dt, finished_flg,
+                                 CASE WHEN finished_flg = 'Y' THEN revision_dt::date END
+                          FROM (SELECT DISTINCT ON (plate_num) *
+                                FROM staging_cars
+                                ORDER BY plate_num, update_dt DESC) AS s
+                          ON CONFLICT (plate_num) DO
+                          UPDATE SET start_dt = EXCLUDED.start_dt, revision_dt = EXCLUDED.revision_dt,
+                                     deleted_flag = EXCLUDED.deleted_flag,
+                                     end_dt = COALESCE(EXCLUDED.end_dt, dim_cars.end_dt)''')
 
         print("dim_cars updated")
 
 
+@logger
 def update_dim_drivers(cursor, drivers):
     """Добавление/обновление данных о водителях"""
     if not drivers.empty:
-        for driver in tqdm(drivers.iterrows()):
-
-            # Дата по умолчанию, при совершении водителем первой поездки она будет обновлена
-            start_date = "1970-01-01"
-            deleted_flag = 'N'
-            driver_license_num, first_name, last_name, middle_name, driver_license_dt, \
-            card_num, update_dt, birth_dt = tuple(driver[1])
-            personnel_num = driver_license_num[-6:]
-
-            # Получаем дату последней поездки водителя
-            cursor.execute(
-                f"select max(work_end_dt) from dwh_voronezh.fact_waybills where driver_pers_num = '{personnel_num}'")
-            end_dt = cursor.fetchall()
-            end_dt = end_dt[0][0]
-            end_dt = end_dt.date() if end_dt else None
-
-            # Вносим изменения в таблицу при помощи SQL-запроса
-            cursor.execute('''INSERT INTO dwh_voronezh.dim_drivers(
-                              personnel_num, start_dt, last_name, first_name, middle_name, birth_dt, card_num,
-                              driver_license_num, driver_license_dt, deleted_flag, end_dt)
-                              VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
-                              ON CONFLICT (personnel_num) DO UPDATE 
-                              SET last_name = %s, first_name = %s, middle_name = %s, card_num = %s,
-                              driver_license_num = %s, driver_license_dt = %s, deleted_flag = %s, end_dt = %s''',
-                              (personnel_num, start_date, last_name, first_name, middle_name, birth_dt, card_num,
-                              driver_license_num, driver_license_dt, deleted_flag, end_dt,
-                              last_name, first_name, middle_name, card_num, driver_license_num,
-                              driver_license_dt, deleted_flag, end_dt))
+        drivers = drivers.iloc[:, :8].copy()
+        drivers.columns = ['driver_license_num', 'first_name', 'last_name', 'middle_name', 'driver_license_dt',
+                           'card_num', 'update_dt', 'birth_dt']
+        drivers['personnel_num'] = drivers['driver_license_num'].str[-6:]
+        copy_to_staging(cursor, drivers, 'staging_drivers',
+                        [('personnel_num', 'text'), ('last_name', 'text'), ('first_name', 'text'),
+                         ('middle_name', 'text'), ('birth_dt', 'timestamp'), ('card_num', 'text'),
+                         ('driver_license_num', 'text'), ('driver_license_dt', 'timestamp'),
+                         ('update_dt', 'timestamp')])
+
+        # start_dt по умолчанию 1970-01-01, при совершении водителем первой поездки она будет обновлена
+        # (end_dt пересчитывается после загрузки фактов в update_dim_end_dt)
+        cursor.execute('''INSERT INTO dwh_voronezh.dim_drivers(
+                          personnel_num, start_dt, last_name, first_name, middle_name, birth_dt, card_num,
+                          driver_license_num, driver_license_dt, deleted_flag, end_dt)
+                          SELECT personnel_num, '1970-01-01', last_name, first_name, middle_name,
+                                 birth_dt, card_num, driver_license_num, driver_license_dt, 'N', NULL
+                          FROM (SELECT DISTINCT ON (personnel_num) *
+                                FROM staging_drivers
+                                ORDER BY personnel_num, update_dt DESC) AS s
+                          ON CONFLICT (personnel_num) DO UPDATE
+                          SET last_name = EXCLUDED.last_name, first_name = EXCLUDED.first_name,
+                              middle_name = EXCLUDED.middle_name, card_num = EXCLUDED.card_num,
+                              driver_license_num = EXCLUDED.driver_license_num,
+                              driver_license_dt = EXCLUDED.driver_license_dt,
+                              deleted_flag = EXCLUDED.deleted_flag''')
 
         print("dim_drivers updated")
 
 
-def update_dim_drivers_start_dt(cursor, personnel_num, date) -> None:
+@logger
+def update_dim_drivers_start_dt(cursor, waybills) -> None:
     """Занесение в таблицу dim_drivers значений start_dt при совершении водителем его первой поездки"""
-    cursor.execute('''DO $$ BEGIN
-                      CASE
-                          WHEN (SELECT start_dt FROM dwh_voronezh.dim_drivers WHERE personnel_num = %s) = '1970-01-01'
-                          THEN 
-                              UPDATE dwh_voronezh.dim_drivers SET start_dt = %s;
-                          ELSE
-                              null;
-                      END CASE;
-                      END $$;''', (personnel_num, date))
-
-
-def update_fact_waybills(cursor, waybill_n, personnel_num, car_plate, start, stop, date) -> None:
-    """Добавление новых путевых листов"""
-    cursor.execute('''INSERT INTO dwh_voronezh.fact_waybills(
-                      waybill_num, driver_pers_num, car_plate_num, work_start_dt, work_end_dt, issue_dt)
-                      VALUES(%s, %s, %s, %s, %s, %s)
-                      ON CONFLICT (waybill_num) DO NOTHING''',
-                      (waybill_n, personnel_num, car_plate, start, stop, date))
+    # start_dt - дата первого путевого листа водителя (путевые листы пачки к этому моменту уже в fact_waybills);
+    # обновляются только водители, у которых еще стоит дата по умолчанию
+    execute_prepared(cursor, 'update_drivers_start_dt',
+                     '''UPDATE dwh_voronezh.dim_drivers AS drivers SET start_dt = first_waybill.start_dt
+                        FROM (SELECT driver_pers_num, min(issue_dt)::date AS start_dt
+                              FROM dwh_voronezh.fact_waybills
+                              WHERE driver_pers_num = ANY(%s)
+                              GROUP BY driver_pers_num) AS first_waybill
+                        WHERE drivers.personnel_num = first_waybill.driver_pers_num
+                          AND drivers.start_dt = '1970-01-01' ''',
+                     (list(waybills['license'].str[-6:].dropna().unique()),))
 
 
-def update_fact_rides(cursor, rides, movement) -> None:
+@logger
+def update_fact_waybills(cursor, waybills) -> None:
+    """Добавление новых путевых листов"""
+    facts = pd.DataFrame({'waybill_num': waybills['number'],
+                          'driver_pers_num': waybills['license'].str[-6:],
+                          'car_plate_num': waybills['car'],
+                          'work_start_dt': waybills['start'],
+                          'work_end_dt': waybills['stop'],
+                          'issue_dt': waybills['issuedt']})
+    insert_facts(cursor, 'dwh_voronezh.fact_waybills', facts, list(facts.columns))
+
+
+def assemble_rides(rides, movement) -> pd.DataFrame:
+    """Сборка поездок из событий movement за один проход"""
+    events = movement if not movement.empty else pd.DataFrame(columns=['ride', 'event', 'dt', 'car_plate_num'])
+    events = events.sort_values('dt', kind='stable')
+
+    # Время первого события каждого типа по каждой поездке (ride x event)
+    times = events.groupby(['ride', 'event'])['dt'].first().unstack().reindex(columns=['READY', 'BEGIN'])
+    times.columns = ['ride_arrival_dt', 'ride_start_dt']
+
+    # Событие окончания поездки (END или CANCEL) и машина, на которой она совершена
+    finish = events[events.event.isin(['END', 'CANCEL'])].groupby('ride')[['event', 'dt', 'car_plate_num']].first()
+    finish.columns = ['end_event', 'ride_end_dt', 'car_plate_num']
+
+    assembled = rides.merge(times, left_on='ride_id', right_index=True, how='left') \
+                     .merge(finish, left_on='ride_id', right_index=True, how='left')
+
+    # У отмененной поездки нет времени начала
+    cancelled = assembled['end_event'] == 'CANCEL'
+    assembled['ride_start_dt'] = assembled['ride_start_dt'].mask(cancelled)
+
+    # Поездка завершена, если есть событие окончания, подача машины и (для не отмененных) начало поездки
+    assembled['finished'] = assembled['end_event'].notna() & assembled['ride_arrival_dt'].notna() & \
+                            (cancelled | assembled['ride_start_dt'].notna())
+    return assembled
+
+
+@logger
+def resolve_drivers(cursor, rides, waybills) -> pd.DataFrame:
+    """Определение водителей поездок по путевым листам (машина + время поездки)"""
+    # Путевые листы из fact_waybills загружаются одним запросом за окно времени поездок
+    execute_prepared(cursor, 'select_ride_waybills',
+                     '''SELECT waybill_num, driver_pers_num, car_plate_num, work_start_dt, work_end_dt
+                        FROM dwh_voronezh.fact_waybills
+                        WHERE work_end_dt >= %s AND work_start_dt <= %s AND car_plate_num = ANY(%s)''',
+                     (rides['dt'].min(), rides['dt'].max(), list(rides['car_plate_num'].dropna().unique())))
+    intervals = records_to_frame(cursor.fetchall(), [desc[0] for desc in cursor.description])
+
+    # К ним добавляются путевые листы, полученные в этом же запуске
+    if not waybills.empty:
+        batch = pd.DataFrame({'waybill_num': waybills['number'],
+                              'driver_pers_num': waybills['license'].str[-6:],
+                              'car_plate_num': waybills['car'],
+                              'work_start_dt': waybills['start'],
+                              'work_end_dt': waybills['stop']})
+        intervals = pd.concat([intervals, batch], ignore_index=True).drop_duplicates('waybill_num')
+
+    # Время поездки и периоды путевых листов приводятся к одному типу
+    intervals['work_start_dt'] = pd.to_datetime(intervals['work_start_dt']).astype('datetime64[ns]')
+    intervals['work_end_dt'] = pd.to_datetime(intervals['work_end_dt']).astype('datetime64[ns]')
+    rides = rides.assign(dt=pd.to_datetime(rides['dt']).astype('datetime64[ns]'))
+
+    # Интервальное соединение: все листы той же машины, период которых покрывает время поездки;
+    # по числу совпадений поездка получает водителя, либо отмечается как без листа или с несколькими листами
+    matches = rides[['ride_id', 'car_plate_num', 'dt']].merge(
+        intervals[['car_plate_num', 'work_start_dt', 'work_end_dt', 'driver_pers_num']], on='car_plate_num')
+    matches = matches[(matches['work_start_dt'] <= matches['dt']) & (matches['dt'] <= matches['work_end_dt'])]
+    found = matches.groupby('ride_id').agg(waybills=('driver_pers_num', 'size'),
+                                           driver_pers_num=('driver_pers_num', 'first'))
+
+    resolved = rides.merge(found, left_on='ride_id', right_index=True, how='left')
+    resolved['driver_status'] = 'resolved'
+    resolved.loc[resolved['waybills'].isna(), 'driver_status'] = 'missing'
+    resolved.loc[resolved['waybills'] > 1, 'driver_status'] = 'ambiguous'
+    resolved.loc[resolved['driver_status'] != 'resolved', 'driver_pers_num'] = None
+
+    for status, message in [('missing', 'не найден путевой лист'), ('ambiguous', 'несколько путевых листов')]:
+        ride_ids = list(resolved.loc[resolved['driver_status'] == status, 'ride_id'])
+        if ride_ids:
+            print(f"Поездки без водителя ({message}): {len(ride_ids)}: {', '.join(map(str, ride_ids))}")
+
+    return resolved.drop(columns=['waybills'])
+
+
+@logger
+def update_fact_rides(cursor, rides, movement, waybills) -> tuple:
     """Добавление новых завершенных поездок"""
-
-    def set_client_dt():
-        """Обновление end_dt в dim_clients"""
-        cursor.execute(f"""UPDATE dwh_voronezh.dim_clients SET end_dt = %s WHERE phone_num = %s""",
-                       (date.date(), client_phone))
-
-    def set_driver_dt():
-        """Обновление end_dt в dim_drivers"""
-        cursor.execute(f"""UPDATE dwh_voronezh.dim_drivers SET end_dt = %s WHERE personnel_num = %s""",
-                       (date.date(), driver_pers_num))
-
-    def set_car_dt():
-        """Обновление end_dt в dim_cars"""
-        cursor.execute(f"""UPDATE dwh_voronezh.dim_cars SET end_dt = %s WHERE plate_num = %s""",
-                       (date.date(), car_plate))
-
-    for record in tqdm(rides.iterrows()):
-        ride_id = record[1].loc['ride_id']
-        date = datetime.strptime(record[1].loc['dt'], '%Y-%m-%d %H:%M:%S')
-        client_phone = record[1].loc['client_phone']
-        point_from = record[1].loc['point_from']
-        point_to = record[1].loc['point_to']
-        distance = record[1].loc['distance']
-        price = record[1].loc['price']
-        ride = movement[(movement.ride == ride_id)]
-
-        try:
-            # Проверяем, что поездка завершена, иначе вызывается ride_id записывается в log_movement_unfinished.txt
-            selected = ride[(ride.event == 'END') | (ride.event == 'CANCEL')].iloc[0]
-            car_plate = selected['car_plate_num']
-
-            # Получаем номер водителя, работающего на данной машине в данное время
-            cursor.execute('''SELECT driver_pers_num
-                              FROM dwh_voronezh.fact_waybills
-                              WHERE work_end_dt >= %s AND work_start_dt <= %s AND car_plate_num = %s''',
-                              (date, date, car_plate))
-            driver_pers_num = cursor.fetchall()[0][0]
-
-            # Обновляем дату последне совершенной поездки в dim_ таблицах
-            set_client_dt()
-            set_driver_dt()
-            set_car_dt()
-
-            if len(selected):
-                # Получаем время прибытия, начала и конца поездки
-                ride_end_dt = selected['dt']
-                ride_start_dt = None if selected['event'] == 'CANCEL' else \
-                    ride[(ride.ride == ride_id) & (ride.event == 'BEGIN')].dt.values[0]
-                ride_arrival_dt = ride[(ride.ride == ride_id) & (ride.event == 'READY')].dt.values[0]
-
-                # Вносим изменения в таблицу при помощи SQL-запроса
-                try:
-                    cursor.execute(f'''INSERT INTO dwh_voronezh.fact_rides(
-                                       ride_id, point_from_txt, point_to_txt, distance_val, price_amt, client_phone_num, 
-                                       driver_pers_num, car_plate_num, ride_start_dt, ride_end_dt, ride_arrival_dt) 
-                                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
-                                       ON CONFLICT (ride_id) DO NOTHING''',
-                                       (ride_id, point_from, point_to, distance, price, client_phone,
-                                       driver_pers_num, car_plate, ride_start_dt, ride_end_dt, ride_arrival_dt))
-                    connection.commit()
-
-                except (Exception, Error) as error:
-                    print("Ошибка sql-запроса: ", error)
-                    connection.rollback()
-
-        except (Exception, Error) as err:
-            os.chdir('log')
-            with open('log_movement_unfinished.txt', 'a') as modified:
-                modified.write(str(ride_id) + '\n')
-            os.chdir('..')
+    if rides.empty:
+        print("fact_rides updated")
+        return pd.DataFrame(columns=['ride_id', 'client_phone', 'driver_pers_num', 'car_plate_num']), []
+
+    assembled = assemble_rides(rides, movement)
+
+    # Незавершенные поездки сохраняются в буфере etl_pending_rides до получения событий окончания
+    unfinished = list(assembled.loc[~assembled['finished'], 'ride_id'])
+
+    # Водители определяются сразу для всех завершенных поездок; поездки без однозначно
+    # найденного водителя остаются незавершенными и будут обработаны при следующем запуске
+    finished = assembled[assembled['finished']]
+    if not finished.empty:
+        finished = resolve_drivers(cursor, finished, waybills)
+        unfinished += list(finished.loc[finished['driver_status'] != 'resolved', 'ride_id'])
+        finished = finished[finished['driver_status'] == 'resolved']
+    else:
+        finished = finished.assign(driver_pers_num=None)
+
+    # Вносим изменения в таблицу одним пакетом
+    facts = finished.rename(columns={'point_from': 'point_from_txt', 'point_to': 'point_to_txt',
+                                     'distance': 'distance_val', 'price': 'price_amt',
+                                     'client_phone': 'client_phone_num'})
+    insert_facts(cursor, 'dwh_voronezh.fact_rides', facts,
+                 ['ride_id', 'point_from_txt', 'point_to_txt', 'distance_val', 'price_amt', 'client_phone_num',
+                  'driver_pers_num', 'car_plate_num', 'ride_start_dt', 'ride_end_dt', 'ride_arrival_dt'])
 
     print("fact_rides updated")
-
-
+    return finished, unfinished
+
+
+@logger
+def update_dim_end_dt(cursor, clients, drivers, cars) -> None:
+    """Пересчет end_dt (дата последней поездки) для затронутых в этом запуске клиентов, водителей и машин"""
+    # Одно агрегирующее обновление на каждую dim_ таблицу; у списанных машин end_dt - дата списания
+    for table, key, keys, fact_key, condition in [
+            ('dim_clients', 'phone_num', clients, 'client_phone_num', ''),
+            ('dim_drivers', 'personnel_num', drivers, 'driver_pers_num', ''),
+            ('dim_cars', 'plate_num', cars, 'car_plate_num', "AND dim.deleted_flag <> 'Y'")]:
+        keys = list(pd.Series(keys, dtype=object).dropna().unique())
+        if not keys:
+            continue
+
+        execute_prepared(cursor, f'update_{table}_end_dt',
+                         f'''UPDATE dwh_voronezh.{table} AS dim SET end_dt = last_ride.end_dt
+                             FROM (SELECT {fact_key} AS key, max(ride_end_dt)::date AS end_dt
+                                   FROM dwh_voronezh.fact_rides
+                                   WHERE {fact_key} = ANY(%s)
+                                   GROUP BY {fact_key}) AS last_ride
+                             WHERE dim.{key} = last_ride.key {condition}''', (keys,))
+
+    print("dim_clients, dim_drivers, dim_cars end_dt updated")
+
+
+@logger
+def reconcile_dimensions(cursor) -> None:
+    """Пересчет start_dt водителей и end_dt всех dim_ таблиц по фактам (после параллельной загрузки частей)"""
+    cursor.execute('''UPDATE dwh_voronezh.dim_drivers AS drivers SET start_dt = first_waybill.start_dt
+                      FROM (SELECT driver_pers_num, min(issue_dt)::date AS start_dt
+                            FROM dwh_voronezh.fact_waybills
+                            GROUP BY driver_pers_num) AS first_waybill
+                      WHERE drivers.personnel_num = first_waybill.driver_pers_num
+                        AND drivers.start_dt = '1970-01-01' ''')
+
+    for table, key, fact_key, condition in [
+            ('dim_clients', 'phone_num', 'client_phone_num', ''),
+            ('dim_drivers', 'personnel_num', 'driver_pers_num', ''),
+            ('dim_cars', 'plate_num', 'car_plate_num', "AND dim.deleted_flag <> 'Y'")]:
+        cursor.execute(f'''UPDATE dwh_voronezh.{table} AS dim SET end_dt = last_ride.end_dt
+                           FROM (SELECT {fact_key} AS key, max(ride_end_dt)::date AS end_dt
+                                 FROM dwh_voronezh.fact_rides
+                                 GROUP BY {fact_key}) AS last_ride
+                           WHERE dim.{key} = last_ride.key
+                             AND dim.end_dt IS DISTINCT FROM last_ride.end_dt {condition}''')
+
+    print("dim_drivers start_dt, dim_clients, dim_drivers, dim_cars end_dt reconciled")
+
+
+@logger
 def update_fact_payments(cursor, payments) -> None:
     """Добавление новых транзакций"""
-    for row in tqdm(payments.iterrows()):
-        card = row[1].loc["card"]
-        date = row[1].loc["date"].replace('.', '-', 2).strip()
-        date = date[-13:-9] + date[2:-13] + date[:2] + date[-9:]
-        amount = row[1].loc["payment amount"]
-
-        # Вносим изменения в таблицу при помощи SQL-запроса
-        cursor.execute('''INSERT INTO dwh_voronezh.fact_payments (
-                            card_num, transaction_amt, transaction_dt)
-                            VALUES(%s, %s, %s) ON CONFLICT DO NOTHING ''',
-                       (card, amount, date))
+    if not payments.empty:
+        facts = pd.DataFrame({'card_num': payments['card'],
+                              'transaction_amt': payments['payment amount'],
+                              'transaction_dt': payments['date']})
+        insert_facts(cursor, 'dwh_voronezh.fact_payments', facts, list(facts.columns))
 
     print('fact_payments updated')
 
 
-def transform_and_load_data(data):
+def merge_replay_buffer(buffer: dict, rides: pd.DataFrame, movement: pd.DataFrame) -> tuple:
+    """Объединение пачки из архива с поездками, не загруженными из предыдущих пачек этой же повторной загрузки"""
+    rides = pd.concat([buffer.get('rides', pd.DataFrame()), rides], ignore_index=True)
+    movement = pd.concat([buffer.get('movement', pd.DataFrame()), movement], ignore_index=True)
+    if not rides.empty:
+        rides = rides.drop_duplicates('ride_id', keep='last')
+    if not movement.empty:
+        movement = movement.drop_duplicates('movement_id', keep='last')
+    return rides, movement
+
+
+def write_replay_buffer(buffer: dict, rides: pd.DataFrame, movement: pd.DataFrame, loaded: list) -> None:
+    """Незагруженные поездки и их события остаются в буфере повторной загрузки до следующих пачек"""
+    buffer['rides'] = rides[~rides['ride_id'].isin(loaded)] if not rides.empty else rides
+    buffer['movement'] = movement[~movement['ride'].isin(loaded)] if not movement.empty else movement
+
+
+@logger
+def transform_and_load_data(data, replay_buffer: dict = None):
     """Внесение полученных на этапе execute данных в конечную БД"""
+    # replay_buffer - буфер незавершенных поездок повторной загрузки из архива (хранится в памяти между пачками);
+    # общий буфер etl_pending_rides при повторной загрузке не читается и не изменяется
     car_pool = pd.DataFrame(data["main.car_pool"])
     rides = pd.DataFrame(data["main.rides"])
     movement = pd.DataFrame(data["main.movement"])
@@ -217,52 +380,70 @@ def transform_and_load_data(data):
     payments = pd.DataFrame(data["payments"])
     waybills = pd.DataFrame(data["waybills"])
 
-    # Подключаемся к конечной базе данных
-    global connection
-    cursor, connection = connect_db(configs=CONFIG, dwh=True)
-
-    # Вносим изменения в dim_drivers
-    update_dim_drivers(cursor, drivers)
-    connection.commit()
+    # Новые контрольные точки сохраняются в той же транзакции, что и данные соответствующего источника
+    checkpoints = data.get("checkpoints", {})
 
-    # Вносим изменения в dim_clients
-    update_dim_clients(cursor, rides)
-    connection.commit()
+    def stage_checkpoints(*sources):
+        return {source: checkpoints[source] for source in sources if source in checkpoints}
 
-    # Вносим изменения в dim_cars
-    update_dim_cars(cursor, car_pool)
-    connection.commit()
+    # Соединение с конечной базой данных берется из общего пула и возвращается в него по завершении
+    with db_session(dwh=True) as (cursor, connection):
+        # Вносим изменения в dim_drivers
+        update_dim_drivers(cursor, drivers)
+        write_checkpoints(cursor, stage_checkpoints("main.drivers"))
+        connection.commit()
 
-    # Берем строки из ДатаФреймов, изначально полученных с ftp сервера
-    if not waybills.empty:
-        for row in tqdm(waybills.iterrows()):
-            cursor = connection.cursor()
-            date = row[1].loc["issuedt"]
-            waybill_n = row[1].loc["number"]
-            car_plate = row[1].loc["car"]
-            driver_license = row[1].loc["license"]
-            personnel_num = driver_license[-6:]
-            start = row[1].loc["start"]
-            stop = row[1].loc["stop"]
+        # Вносим изменения в dim_clients
+        update_dim_clients(cursor, rides)
+        connection.commit()
 
-            # Задаем start_dt в dim_drivers
-            update_dim_drivers_start_dt(cursor, personnel_num, date)
-            connection.commit()
+        # Вносим изменения в dim_cars
+        update_dim_cars(cursor, car_pool)
+        write_checkpoints(cursor, stage_checkpoints("main.car_pool"))
+        connection.commit()
 
+        # Каждый этап загрузки фактов выполняется одной транзакцией
+        # Берем строки из ДатаФреймов, изначально полученных с ftp сервера
+        if not waybills.empty:
             # Вносим изменения в fact_waybills
-            update_fact_waybills(cursor, waybill_n, personnel_num, car_plate, start, stop, date)
-            connection.commit()
+            update_fact_waybills(cursor, waybills)
 
-        print("dim_drivers, fact_waybills updated")
-
-    # Вносим изменения в fact_payments
-    update_fact_payments(cursor, payments)
-    connection.commit()
-
-    # Вносим изменения в fact_rides
-    update_fact_rides(cursor, rides, movement)
-    connection.commit()
+            # Задаем start_dt в dim_drivers
+            update_dim_drivers_start_dt(cursor, waybills)
+
+            print("dim_drivers, fact_waybills updated")
+        write_checkpoints(cursor, stage_checkpoints("ftp:waybills"))
+        connection.commit()
+
+        # Вносим изменения в fact_payments
+        update_fact_payments(cursor, payments)
+        write_checkpoints(cursor, stage_checkpoints("ftp:payments"))
+        connection.commit()
+
+        # Вносим изменения в fact_rides и обновляем end_dt в dim_ таблицах (одна транзакция);
+        # новые строки объединяются с буфером поездок, незавершенных в прошлых запусках
+        if replay_buffer is None:
+            pending_rides, pending_movement = merge_pending_rides(cursor, rides, movement)
+        else:
+            pending_rides, pending_movement = merge_replay_buffer(replay_buffer, rides, movement)
+        loaded, unfinished = update_fact_rides(cursor, pending_rides, pending_movement, waybills)
+
+        # Затронутые в этом запуске ключи: записи из пачек dim_ таблиц и участники загруженных поездок
+        batch_clients = rides['client_phone'] if not rides.empty else []
+        batch_drivers = drivers.iloc[:, 0].str[-6:] if not drivers.empty else []
+        batch_cars = car_pool.iloc[:, 0] if not car_pool.empty else []
+        update_dim_end_dt(cursor,
+                          clients=list(batch_clients) + list(loaded['client_phone']),
+                          drivers=list(batch_drivers) + list(loaded['driver_pers_num']),
+                          cars=list(batch_cars) + list(loaded['car_plate_num']))
+
+        # Загруженные поездки удаляются из буфера, незавершенные сохраняются в нем вместе с событиями
+        if replay_buffer is None:
+            write_pending_rides(cursor, pending_rides, pending_movement, list(loaded['ride_id']), unfinished,
+                                incoming_ride_ids(rides, movement))
+        else:
+            write_replay_buffer(replay_buffer, pending_rides, pending_movement, list(loaded['ride_id']))
+        write_checkpoints(cursor, stage_checkpoints("main.rides", "main.movement"))
+        connection.commit()
 
-    # Отключаемся от конечной базы данных
-    disconnect_db(connection, cursor)
     print('____________________________________________________________________________________________________\n')
\ No newline at end of file